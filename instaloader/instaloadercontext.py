@@ -14,16 +14,34 @@ from functools import partial
 from typing import Any, Callable, Dict, Iterator, List, Optional, Union
 
 import requests
+import requests.adapters
 import requests.utils
 
 from .exceptions import *
 
 
+class SharedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connection pool outlives the sessions it is mounted on.
+
+    :func:`copy_session` mounts it on the duplicated sessions as well, so short-lived sessions reuse the
+    established keep-alive connections. Closing a session does not close the pool, call :meth:`close_pool`
+    for that."""
+
+    def close(self):
+        pass
+
+    def close_pool(self):
+        super().close()
+
+
 def copy_session(session: requests.Session, request_timeout: Optional[float] = None) -> requests.Session:
     """Duplicates a requests.Session."""
     new = requests.Session()
     new.cookies = requests.utils.cookiejar_from_dict(requests.utils.dict_from_cookiejar(session.cookies))
     new.headers = session.headers.copy()  # type: ignore
+    for prefix, adapter in session.adapters.items():
+        if isinstance(adapter, SharedHTTPAdapter):
+            new.mount(prefix, adapter)
     # Override default timeout behavior.
     # Need to silence mypy bug for this. See: https://github.com/python/mypy/issues/2427
     new.request = partial(new.request, timeout=request_timeout)  # type: ignore
@@ -1,44 +1,681 @@
 import re
 import json
+import html
+import time
+import hashlib
+import os
+import shutil
+import tempfile
 import mimetypes
+import random
+import email.utils
 import instaloader
 import urllib
 import yarl
-import requests
 import asyncio
+import aiohttp
 import concurrent.futures
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from urllib.parse import urljoin
+from xml.etree import ElementTree
+from instaloader.instaloadercontext import SharedHTTPAdapter
 
-from typing import Type
-from urllib.parse import quote
-from mautrix.types import ImageInfo, EventType, MessageType
+from typing import IO, Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from mautrix.types import ContentURI, EventID, ImageInfo, EventType, MessageType, RedactionEvent
 from mautrix.types.event.message import BaseFileInfo, Format, TextMessageEventContent
+from mautrix.util.async_db import Connection, UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin, MessageEvent
 from maubot.handlers import event
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
-        for prefix in ["reddit", "instagram", "youtube", "tiktok"]:
+        for prefix in ["reddit", "instagram", "youtube", "tiktok", "bluesky"]:
             for suffix in ["enabled", "info", "image", "video", "thumbnail"]:
                 helper.copy(f"{prefix}.{suffix}")
 
+        helper.copy("cache.max_entries")
+        helper.copy("cache.max_age")
+        helper.copy("cache.post_ttl")
+        helper.copy("cache.prune_interval")
+        helper.copy("cache.missing_ttl")
+        helper.copy("circuit_breaker.threshold")
+        helper.copy("circuit_breaker.cooldown")
+        helper.copy("timeouts.resolve")
+        helper.copy("timeouts.download")
+        helper.copy("timeouts.upload")
+        helper.copy("timeouts.send")
+        helper.copy("timeouts.job")
+        helper.copy("jobs.per_event")
+        helper.copy("jobs.max_queue")
+        helper.copy("jobs.max_per_room")
+        helper.copy("jobs.max_bytes")
+        helper.copy("jobs.platforms")
+        helper.copy("download.spool_size")
+        helper.copy("download.gallery_concurrency")
+        helper.copy("download.max_pixels")
+        helper.copy("download.max_size")
+        helper.copy("download.retries")
+        helper.copy("download.backoff")
+        helper.copy("download.max_retry_after")
+        helper.copy("download.hedge")
+        helper.copy("bluesky.batch_delay")
+        helper.copy("bluesky.handle_ttl")
+        helper.copy("bluesky.segment_concurrency")
+        helper.copy("bluesky.segment_retries")
+        helper.copy("youtube.cache_ttl")
+        helper.copy("reddit.batch_delay")
+        helper.copy("reddit.native_dash")
+        helper.copy("tiktok.token_ttl")
+        helper.copy("instagram.workers")
         helper.copy("respond_to_notice")
 
-reddit_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|m|old|nm)\.)?((?:reddit\.com|redd\.it))(\/r\/[^/]+\/(?:comments|s)\/[a-zA-Z0-9_\-]+)")
-instagram_pattern = re.compile(r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/?([a-zA-Z0-9\.\_\-]+)?\/([p]+)?([reel]+)?([tv]+)?([stories]+)?\/([a-zA-Z0-9\-\_\.]+)\/?([0-9]+)?")
 youtube_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|m)\.)?((?:youtube\.com|youtu\.be))(\/(?:[\w\-]+\?v=|embed\/|v\/)?)([\w\-]+)(\S+)?")
-tiktok_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|m|vm)\.)?((?:tiktok\.com))(\/[@a-zA-Z0-9\-\_\.]+)?(\/video\/)?([a-zA-Z0-9\-\_]+)?")
 bluesky_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|bsky)\.)?((?:bsky\.app))(\/profile\/[a-zA-Z0-9\-\_\.]+)(\/post\/[a-zA-Z0-9\-\_]+)")
+# A single character class, so matching a path segment can't backtrack
+link_segment_pattern = re.compile(r"[a-zA-Z0-9_.@\-]+")
+
+def split_link(token: str, domain: re.Match, subdomains: Tuple[str, ...]) -> Tuple[str, str, List[str]]:
+    # Splits a link around an already found domain into scheme, subdomain and path segments.
+    # Every step is a plain string operation over the token, so the cost is linear in its length.
+    prefix = token[:domain.start()]
+    subdomain = next((f"{sub}." for sub in sorted(subdomains, key=len, reverse=True) if prefix.endswith(f"{sub}.")), "")
+    prefix = prefix[:len(prefix) - len(subdomain)]
+    scheme = next((scheme for scheme in ("https://", "http://", "//") if prefix.endswith(scheme)), "")
+
+    segments = []
+    path = token[domain.end():].split("?", 1)[0].split("#", 1)[0]
+    if path.startswith("/"):
+        for segment in path[1:].split("/"):
+            match = link_segment_pattern.match(segment)
+            if not match:
+                break
+            segments.append(match.group(0))
+            # Anything else, like a closing bracket, ends the link
+            if match.end() < len(segment):
+                break
+    return scheme, subdomain, segments
+
+def parse_reddit_link(token: str, domain: re.Match) -> Optional[Tuple[str, ...]]:
+    # (scheme, subdomain, domain, "/r/<sub>/comments|s/<id>")
+    scheme, subdomain, segments = split_link(token, domain, ("www", "m", "old", "nm"))
+    if len(segments) < 4 or segments[0] != "r" or segments[2] not in ("comments", "s"):
+        return None
+    return scheme, subdomain, domain.group(0), f"/r/{segments[1]}/{segments[2]}/{segments[3]}"
+
+def parse_instagram_link(token: str, domain: re.Match) -> Optional[Tuple[str, ...]]:
+    # (username, "p", "reel", "tv", "stories", shortcode, story id), the post type is set in its own field
+    _, _, segments = split_link(token, domain, ("www",))
+    kinds = {"p": 1, "reel": 2, "reels": 2, "tv": 3, "stories": 4}
+    username = ""
+    if len(segments) >= 3 and segments[0] not in kinds and segments[1] in kinds:
+        username, segments = segments[0], segments[1:]
+    if len(segments) < 2 or segments[0] not in kinds:
+        return None
+    fields = [username, "", "", "", "", segments[1], ""]
+    fields[kinds[segments[0]]] = segments[0]
+    if segments[0] == "stories" and len(segments) >= 3 and segments[2].isdigit():
+        fields[6] = segments[2]
+    return tuple(fields)
+
+def parse_tiktok_link(token: str, domain: re.Match) -> Optional[Tuple[str, ...]]:
+    # (scheme, subdomain, domain, "/@user" or short link path, "/video/", video id)
+    scheme, subdomain, segments = split_link(token, domain, ("www", "m", "vm"))
+    if not segments:
+        return None
+    if len(segments) >= 3 and segments[1] == "video":
+        return scheme, subdomain, domain.group(0), f"/{segments[0]}", "/video/", segments[2]
+    return scheme, subdomain, domain.group(0), "/" + "/".join(segments), "", ""
+
+def parse_youtube_link(token: str, domain: re.Match) -> Optional[Tuple[str, ...]]:
+    match = youtube_pattern.search(token)
+    return match.groups(default='') if match else None
+
+def parse_bluesky_link(token: str, domain: re.Match) -> Optional[Tuple[str, ...]]:
+    match = bluesky_pattern.search(token)
+    return match.groups(default='') if match else None
+
+link_domain_pattern = re.compile(r"youtube\.com|youtu\.be|instagram\.com|reddit\.com|redd\.it|tiktok\.com|bsky\.app")
+link_domains = {
+    "youtube.com": ("youtube", parse_youtube_link),
+    "youtu.be": ("youtube", parse_youtube_link),
+    "instagram.com": ("instagram", parse_instagram_link),
+    "reddit.com": ("reddit", parse_reddit_link),
+    "redd.it": ("reddit", parse_reddit_link),
+    "tiktok.com": ("tiktok", parse_tiktok_link),
+    "bsky.app": ("bluesky", parse_bluesky_link),
+}
+
+def find_links(body: str) -> List[Tuple[str, Tuple[str, ...]]]:
+    # Almost no message contains a supported link, so bail out after a single scan for the domains.
+    # Otherwise only the whitespace separated tokens containing a domain are parsed by that
+    # platform's parser, and links are returned in the order they appear in the message.
+    if not link_domain_pattern.search(body):
+        return []
+    links = []
+    for token in body.split():
+        domains = list(link_domain_pattern.finditer(token))
+        for i, domain in enumerate(domains):
+            # Links without whitespace between them (a,b) share a token, each of them is parsed
+            # from the text between the domains before and after it
+            if len(domains) > 1:
+                start = domains[i - 1].end() if i else 0
+                end = domains[i + 1].start() if i + 1 < len(domains) else len(token)
+                part = token[start:end]
+                domain = link_domain_pattern.search(part)
+            else:
+                part = token
+            platform, parse = link_domains[domain.group(0)]
+            url_tup = parse(part, domain)
+            if url_tup:
+                links.append((platform, url_tup))
+    return links
+
+# A link can be written in many ways (youtu.be or m.youtube.com, old.reddit.com, tracking parameters, ...),
+# so caches and in-flight jobs are keyed by the post it points to instead of by the link itself.
+
+def youtube_video_id(url_tup: Tuple[str, ...]) -> Optional[str]:
+    # (scheme, subdomain, domain, "/watch?v=" or "/embed/" or "/", video id or first path segment, rest)
+    _, _, domain, prefix, first, rest = url_tup
+    if domain == "youtu.be" or prefix.endswith("?v=") or prefix in ("/embed/", "/v/"):
+        return first or None
+    if first in ("shorts", "live", "embed", "v"):
+        match = link_segment_pattern.match(rest.lstrip("/"))
+        return match.group(0) if match else None
+    video_id = urllib.parse.parse_qs(urllib.parse.urlparse(rest).query).get("v", [""])[0]
+    return video_id if re.fullmatch(r"[\w\-]+", video_id) else None
+
+def canonical_post_id(platform: str, url_tup: Tuple[str, ...]) -> Optional[str]:
+    # Identifier of the post that is known without contacting the platform, None if there is none.
+    # Together with the platform, it is the same for every link to the same post.
+    if platform == "youtube":
+        return youtube_video_id(url_tup)
+    elif platform == "instagram":
+        # Story links only contain the username
+        return url_tup[5] if not url_tup[4] else None
+    elif platform == "reddit":
+        # Share links (/r/<sub>/s/<id>) have to be followed first
+        match = re.fullmatch(r"/r/[^/]+/comments/([a-zA-Z0-9]+)", url_tup[3])
+        return match.group(1).lower() if match else None
+    elif platform == "tiktok":
+        if url_tup[5]:
+            return url_tup[5]
+        # Short links are only unique together with their domain
+        subdomain = url_tup[1] if url_tup[1] == "vm." else ""
+        return f"{subdomain}{url_tup[2]}{url_tup[3]}"
+    elif platform == "bluesky":
+        # Handles are case insensitive, record keys aren't
+        return f"{url_tup[3].split('/')[-1].lower()}/{url_tup[4].split('/')[-1]}"
+    return None
+
+def canonical_url(platform: str, post_id: str) -> str:
+    if platform == "youtube":
+        return f"https://www.youtube.com/watch?v={post_id}"
+    elif platform == "instagram":
+        return f"https://www.instagram.com/p/{post_id}/"
+    elif platform == "reddit":
+        return f"https://www.reddit.com/comments/{post_id}/"
+    elif platform == "tiktok":
+        return f"https://www.tiktok.com/video/{post_id}" if post_id.isdigit() else f"https://{post_id}"
+    elif platform == "bluesky":
+        handle, rkey = post_id.split("/", 1)
+        return f"https://bsky.app/profile/{handle}/post/{rkey}"
+    raise ValueError(f"Unknown platform {platform}")
+
+def post_file_name(post_id: str, suffix: str) -> str:
+    # Deterministic across restarts, unlike hash(), and safe to use as a file name
+    return re.sub(r"[^\w\-]", "_", post_id) + suffix
+
+upgrade_table = UpgradeTable()
+
+@upgrade_table.register(description="Add resolved post cache")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE resolved_post (
+            platform   TEXT NOT NULL,
+            post_id    TEXT NOT NULL,
+            info       TEXT,
+            info_html  TEXT,
+            media      TEXT NOT NULL,
+            fetched_at BIGINT NOT NULL,
+            PRIMARY KEY (platform, post_id)
+        )"""
+    )
+    await conn.execute("CREATE INDEX resolved_post_fetched_at_idx ON resolved_post (fetched_at)")
+
+@upgrade_table.register(description="Key resolved posts by the options they were resolved with")
+async def upgrade_v2(conn: Connection) -> None:
+    # The table is only a cache, so the old rows are dropped instead of guessing their options
+    await conn.execute("DROP TABLE resolved_post")
+    await conn.execute(
+        """CREATE TABLE resolved_post (
+            platform   TEXT NOT NULL,
+            post_id    TEXT NOT NULL,
+            options    TEXT NOT NULL,
+            info       TEXT,
+            info_html  TEXT,
+            media      TEXT NOT NULL,
+            fetched_at BIGINT NOT NULL,
+            PRIMARY KEY (platform, post_id, options)
+        )"""
+    )
+    await conn.execute("CREATE INDEX resolved_post_fetched_at_idx ON resolved_post (fetched_at)")
+
+class SegmentDownloadError(Exception):
+    pass
+
+@dataclass
+class Rendition:
+    url: str
+    width: int = 0
+    height: int = 0
+    bandwidth: int = 0
+
+def choose_rendition(renditions: List[Rendition], max_pixels: int = 0, max_bytes: float = 0, duration: float = 0) -> Optional[Rendition]:
+    # The best rendition within the pixel and byte budget, as far as its size is known, or the
+    # smallest one if none fits. The byte size of streams is estimated from bandwidth and duration.
+    def fits(rendition: Rendition) -> bool:
+        if max_pixels and rendition.width * rendition.height > max_pixels:
+            return False
+        if max_bytes and duration and rendition.bandwidth * duration / 8 > max_bytes:
+            return False
+        return True
+
+    ranked = sorted(renditions, key=lambda rendition: (rendition.width * rendition.height, rendition.bandwidth))
+    fitting = [rendition for rendition in ranked if fits(rendition)]
+    if fitting:
+        return fitting[-1]
+    return ranked[0] if ranked else None
+
+def parse_hls_variants(playlist: str, playlist_url: str) -> List[Rendition]:
+    variants = []
+    attributes = None
+    for line in playlist.strip().splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = dict(re.findall(r'([A-Z0-9\-]+)=("[^"]*"|[^,]*)', line.split(":", 1)[1]))
+        elif line and not line.startswith("#") and attributes is not None:
+            width, _, height = attributes.get("RESOLUTION", "").partition("x")
+            variants.append(Rendition(url=urljoin(playlist_url, line),
+                                      width=int(width) if width.isdigit() else 0,
+                                      height=int(height) if height.isdigit() else 0,
+                                      bandwidth=int(attributes.get("BANDWIDTH", "0").strip('"') or 0)))
+            attributes = None
+    return variants
+
+@dataclass
+class DashManifest:
+    duration: float
+    videos: List[Rendition]
+    audios: List[Rendition]
+
+def parse_iso_duration(duration: str) -> float:
+    match = re.fullmatch(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?", duration or "")
+    if not match:
+        return 0.0
+    hours, minutes, seconds = match.groups(default="0")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def parse_dash_manifest(text: str, manifest_url: str) -> DashManifest:
+    # Only what reddit's DASHPlaylist.mpd uses: one period with a video and an audio adaptation set
+    # whose representations have a BaseURL relative to the manifest.
+    def children(element, name):
+        return [child for child in element if child.tag.rsplit("}", 1)[-1] == name]
+
+    root = ElementTree.fromstring(text)
+    manifest = DashManifest(duration=parse_iso_duration(root.get("mediaPresentationDuration")), videos=[], audios=[])
+    for adaptation_set in (el for el in root.iter() if el.tag.rsplit("}", 1)[-1] == "AdaptationSet"):
+        for representation in children(adaptation_set, "Representation"):
+            base_url = next(iter(children(representation, "BaseURL")), None)
+            if base_url is None or not base_url.text:
+                continue
+            content_type = (adaptation_set.get("contentType") or adaptation_set.get("mimeType")
+                            or representation.get("mimeType") or "")
+            rendition = Rendition(url=urljoin(manifest_url, base_url.text.strip()),
+                                           bandwidth=int(representation.get("bandwidth", 0)),
+                                           width=int(representation.get("width", 0)),
+                                           height=int(representation.get("height", 0)))
+            if content_type.startswith("audio"):
+                manifest.audios.append(rendition)
+            elif content_type.startswith("video"):
+                manifest.videos.append(rendition)
+    return manifest
+
+class MediaTooLarge(Exception):
+    pass
+
+class PostNotFound(Exception):
+    pass
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    # Stops contacting an upstream after `threshold` consecutive failures. Once `cooldown` seconds
+    # have passed a single probe request is let through again (half-open), and its outcome either
+    # closes the circuit or opens it for another cooldown.
+    def __init__(self, name: str, threshold: int, cooldown: float) -> None:
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+
+    def check(self) -> None:
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            raise CircuitOpen(f"{self.name} failed {self.failures} times in a row, "
+                              f"retrying in {self.cooldown - (now - self.opened_at):.0f}s")
+        # A probe that never reported back (e.g. it was cancelled) doesn't block the circuit forever
+        if self.probe_started is not None and now - self.probe_started < self.cooldown:
+            raise CircuitOpen(f"{self.name} is being probed after {self.failures} failures")
+        self.probe_started = now
+
+    def record(self, status: int) -> None:
+        # Rate limits and server errors mean the upstream is struggling, anything else that it works
+        if status == 429 or status >= 500:
+            self.failure()
+        else:
+            self.success()
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probe_started is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probe_started = None
+
+class JobScheduler:
+    # Admission control for link jobs: a global and per-room limit on queued jobs, a worker limit
+    # per platform and a budget for the bytes that are transferred at the same time.
+    def __init__(self, platform_limits: dict, max_queue: int, max_per_room: int, max_bytes: int) -> None:
+        self.platform_limits = platform_limits
+        self.max_queue = max_queue
+        self.max_per_room = max_per_room
+        self.max_bytes = max_bytes
+        self.semaphores = {}
+        self.queued = 0
+        self.queued_per_room = Counter()
+        self.bytes_in_flight = 0
+        self.bytes_changed = asyncio.Condition()
+
+    def semaphore(self, platform: str) -> asyncio.Semaphore:
+        if platform not in self.semaphores:
+            self.semaphores[platform] = asyncio.Semaphore(max(1, self.platform_limits.get(platform, 1)))
+        return self.semaphores[platform]
+
+    def admit(self, room_id: str, count: int) -> int:
+        # Takes queue slots for the links of a message as soon as they are found, so a message with
+        # many links gets no more than the room's share. Returns how many of the links were admitted,
+        # each of them has to be released once it is done.
+        admitted = max(0, min(count, self.max_queue - self.queued, self.max_per_room - self.queued_per_room[room_id]))
+        if admitted:
+            self.queued += admitted
+            self.queued_per_room[room_id] += admitted
+        return admitted
+
+    def release(self, room_id: str) -> None:
+        self.queued -= 1
+        self.queued_per_room[room_id] -= 1
+        if not self.queued_per_room[room_id]:
+            del self.queued_per_room[room_id]
+
+    @asynccontextmanager
+    async def job(self, platform: str):
+        async with self.semaphore(platform):
+            yield
+
+    @asynccontextmanager
+    async def transfer(self, size: int):
+        # A transfer larger than the whole budget is let through once nothing else is in flight
+        async with self.bytes_changed:
+            await self.bytes_changed.wait_for(
+                lambda: self.bytes_in_flight == 0 or self.bytes_in_flight + size <= self.max_bytes)
+            self.bytes_in_flight += size
+        try:
+            yield
+        finally:
+            async with self.bytes_changed:
+                self.bytes_in_flight -= size
+                self.bytes_changed.notify_all()
+
+CHUNK_SIZE = 64 * 1024
+# Statuses of media requests that are worth trying again
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# Failures of a single download or upload, which only leave that media out of the post
+MEDIA_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+async def iter_file(file: IO[bytes], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    # Files can be on disk (spooled ones once they outgrow spool_size), so reads don't block the event loop
+    loop = asyncio.get_running_loop()
+    while chunk := await loop.run_in_executor(None, file.read, chunk_size):
+        yield chunk
+
+async def iter_hashed(chunks: AsyncIterator[bytes], digest) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+@dataclass
+class InstagramPostInfo:
+    owner_username: str
+    caption: Optional[str]
+    caption_hashtags: List[str]
+    caption_mentions: List[str]
+    likes: int
+    comments: int
+    is_video: bool
+    url: str
+    video_url: Optional[str]
+
+@dataclass
+class UploadedMedia:
+    uri: ContentURI
+    mimetype: str
+    size: int
+
+@dataclass
+class PostMedia:
+    uri: ContentURI
+    mimetype: str
+    size: int
+    file_name: str
+    msgtype: MessageType
+
+@dataclass
+class ResolvedPost:
+    info: Optional[str] = None
+    info_html: Optional[str] = None
+    media: List[PostMedia] = field(default_factory=list)
+    # False if some of the media could not be fetched, such posts are not persisted
+    complete: bool = True
+    # The info without numbers that change all the time (likes, comments), which is what gets
+    # persisted. None if the info has no such numbers.
+    lasting_info: Optional[str] = None
+    lasting_info_html: Optional[str] = None
+
+    def media_json(self) -> str:
+        return json.dumps([{"uri": m.uri, "mimetype": m.mimetype, "size": m.size, "file_name": m.file_name,
+                            "msgtype": m.msgtype.value} for m in self.media])
+
+    @classmethod
+    def from_row(cls, row) -> "ResolvedPost":
+        media = [PostMedia(uri=ContentURI(m["uri"]), mimetype=m["mimetype"], size=m["size"], file_name=m["file_name"],
+                           msgtype=MessageType(m["msgtype"])) for m in json.loads(row["media"])]
+        return cls(info=row["info"], info_html=row["info_html"], media=media)
+
+class RequestBatcher:
+    # Collects the keys requested within `delay` seconds (up to max_size of them) and looks them
+    # all up with a single call of fetch, which returns a dict of the keys it found.
+    def __init__(self, fetch: Callable[[List[str]], Awaitable[Dict[str, Any]]], delay: float, max_size: int) -> None:
+        self.fetch = fetch
+        self.delay = delay
+        self.max_size = max_size
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks = set()
+
+    async def get(self, key: str) -> Any:
+        future = self.pending.get(key)
+        if not future:
+            loop = asyncio.get_running_loop()
+            future = self.pending[key] = loop.create_future()
+            if len(self.pending) >= self.max_size:
+                self.flush()
+            elif not self.timer:
+                self.timer = loop.call_later(self.delay, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        task = asyncio.create_task(self.run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: Dict[str, asyncio.Future]) -> None:
+        try:
+            results = await self.fetch(list(batch))
+        except asyncio.CancelledError:
+            self.fail(batch, RuntimeError("Request batcher was closed"))
+            raise
+        except Exception as e:
+            self.fail(batch, e)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+    @staticmethod
+    def fail(batch: Dict[str, asyncio.Future], e: Exception) -> None:
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(e)
+
+    def close(self) -> None:
+        # Keys that are still waiting for their batch fail, instead of waiting forever
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        self.fail(batch, RuntimeError("Request batcher was closed"))
+        for task in self.tasks:
+            task.cancel()
+
+class TTLCache:
+    # In-memory cache that evicts the least recently used entries and entries older than max_age.
+    def __init__(self, max_entries: int, max_age: float) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries: OrderedDict[Any, Tuple[float, Any]] = OrderedDict()
+
+    def get(self, key) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if time.monotonic() - created > self.max_age:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class LatencyTracker:
+    # Seconds until the response headers arrived, for the most recent requests to a host
+    def __init__(self, max_samples: int = 100, min_samples: int = 20) -> None:
+        self.samples = deque(maxlen=max_samples)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        # None until there are enough samples to tell a slow request from a normal one
+        if len(self.samples) < self.min_samples:
+            return None
+        ranked = sorted(self.samples)
+        return ranked[min(len(ranked) - 1, int(fraction * len(ranked)))]
 
 class SocialMediaDownloadPlugin(Plugin):
     async def start(self) -> None:
         self.config.load_and_update()
+        # Maps "url:<source url>" and "sha256:<content hash>" to media that is already on the homeserver
+        self.upload_cache = TTLCache(self.config["cache.max_entries"], self.config["cache.max_age"])
+        # Reddit share links always point to the same post, so they never need to expire
+        self.reddit_redirects = TTLCache(self.config["cache.max_entries"], float("inf"))
+        self.youtube_oembed = TTLCache(self.config["cache.max_entries"], self.config["youtube.cache_ttl"])
+        self.bluesky_dids = TTLCache(self.config["cache.max_entries"], self.config["bluesky.handle_ttl"])
+        self.bluesky_handles = RequestBatcher(self.fetch_bluesky_dids, self.config["bluesky.batch_delay"], 25)
+        # getPosts accepts up to 25 URIs
+        self.bluesky_posts = RequestBatcher(self.fetch_bluesky_posts, self.config["bluesky.batch_delay"], 25)
+        self.ffmpeg = shutil.which("ffmpeg") if self.config["reddit.native_dash"] else None
+        if self.config["reddit.native_dash"] and not self.ffmpeg:
+            self.log.warning("ffmpeg not found, reddit videos are downloaded through rapidsave.com")
+        self.reddit_posts = RequestBatcher(self.fetch_reddit_posts, self.config["reddit.batch_delay"], 100)
+        self.inflight_posts = {}
+        self.post_waiters = Counter()
+        # Handlers of the messages that are being processed, so they can be cancelled if the message is redacted
+        self.event_tasks: Dict[EventID, asyncio.Task] = {}
+        # Links to posts that don't exist (anymore), so they aren't looked up again for every message
+        self.missing_posts = TTLCache(self.config["cache.max_entries"], self.config["cache.missing_ttl"])
+        self.breakers = {name: CircuitBreaker(name, self.config["circuit_breaker.threshold"], self.config["circuit_breaker.cooldown"])
+                         for name in ("ttdownloader.com", "sd.rapidsave.com", "public.api.bsky.app", "instagram.com")}
+        self.upload_limit = None
+        # Per host, CDNs of different platforms (and regions) respond at very different speeds
+        self.fetch_latency = TTLCache(100, float("inf"))
+        self.ttdownloader_lock = asyncio.Lock()
+        self.ttdownloader_tokens = None
+        self.ttdownloader_tokens_expiry = 0.0
+        # Instagram links are processed by as many jobs as there are Instaloader threads, more would only queue up in the executor
+        platform_limits = {**self.config["jobs.platforms"], "instagram": max(1, self.config["instagram.workers"])}
+        self.scheduler = JobScheduler(platform_limits, self.config["jobs.max_queue"],
+                                      self.config["jobs.max_per_room"], self.config["jobs.max_bytes"])
+        # Instaloader is blocking (requests + time.sleep for rate limiting), so all of its work
+        # happens in a small dedicated pool instead of on the event loop.
+        self.instagram_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self.config["instagram.workers"]), thread_name_prefix="instaloader")
+        self.instagram_jobs = 0
+        # One Instaloader for the whole plugin lifetime, so connections are kept alive and the
+        # RateController sees all queries instead of starting from scratch for every link.
+        self.instaloader = instaloader.Instaloader(quiet=True, request_timeout=self.config["timeouts.resolve"] or 300.0, user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36")
+        self.instagram_adapter = SharedHTTPAdapter(pool_maxsize=max(1, self.config["instagram.workers"]))
+        self.instaloader.context._session.mount("https://", self.instagram_adapter)
+        self.prune_task = asyncio.create_task(self.prune_posts())
+
+    async def stop(self) -> None:
+        self.prune_task.cancel()
+        self.reddit_posts.close()
+        self.bluesky_handles.close()
+        self.bluesky_posts.close()
+        self.instagram_executor.shutdown(wait=False, cancel_futures=True)
+        self.instaloader.close()
+        self.instagram_adapter.close_pool()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
+
     @event.on(EventType.ROOM_MESSAGE)
     async def on_message(self, evt: MessageEvent) -> None:
         if (evt.content.msgtype != MessageType.TEXT and
@@ -47,30 +684,287 @@ class SocialMediaDownloadPlugin(Plugin):
             return
 
 
-        for url_tup in youtube_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["youtube.enabled"]:
-                await self.handle_youtube(evt, url_tup)
+        links = find_links(evt.content.body)
+        if not links:
+            return
 
-        for url_tup in instagram_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["instagram.enabled"] and url_tup[5]:
-                await self.handle_instagram(evt, url_tup)
+        await evt.mark_read()
+        links = [(platform, url_tup) for platform, url_tup in links
+                 if self.config[f"{platform}.enabled"]]
+        admitted = self.scheduler.admit(evt.room_id, len(links))
+        if admitted < len(links):
+            self.log.warning(f"Ignoring {len(links) - admitted} of {len(links)} links in {evt.event_id}: "
+                             f"{self.scheduler.queued} links are queued, {self.scheduler.queued_per_room[evt.room_id]} of them for {evt.room_id}")
+            links = links[:admitted]
+        self.event_tasks[evt.event_id] = asyncio.current_task()
 
-        for url_tup in reddit_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["reddit.enabled"]:
-                await self.handle_reddit(evt, url_tup)
+        # Links are resolved concurrently, but replies are sent in the order the links appear in the message
+        semaphore = asyncio.Semaphore(max(1, self.config["jobs.per_event"]))
 
-        for url_tup in tiktok_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["tiktok.enabled"]:
-                await self.handle_tiktok(evt, url_tup)
-        
-        if self.config["bluesky.enabled"]:
-            for url_tup in bluesky_pattern.findall(evt.content.body):
-                await evt.mark_read()
-                await self.handle_bluesky(evt, url_tup)
+        async def get_post(platform, url_tup) -> Optional[ResolvedPost]:
+            async with semaphore:
+                try:
+                    return await self.get_post(platform, url_tup)
+                except CircuitOpen as e:
+                    self.log.warning(f"Ignoring {platform} link {''.join(url_tup)}: {e}")
+                    return None
+
+        tasks = [asyncio.create_task(get_post(platform, url_tup)) for platform, url_tup in links]
+        for task in tasks:
+            # Also called for tasks that are cancelled before they even started
+            task.add_done_callback(lambda _: self.scheduler.release(evt.room_id))
+        try:
+            for (platform, url_tup), task in zip(links, tasks):
+                try:
+                    post = await task
+                    if post:
+                        await self.send_post(evt, post)
+                except asyncio.TimeoutError:
+                    self.log.warning(f"Timed out handling {platform} link {''.join(url_tup)}")
+                except Exception:
+                    self.log.exception(f"Failed to handle {platform} link {''.join(url_tup)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.event_tasks.pop(evt.event_id, None)
+
+    @event.on(EventType.ROOM_REDACTION)
+    async def on_redaction(self, evt: RedactionEvent) -> None:
+        # Nothing is posted in reply to a message that is gone, and jobs no other message waits for are stopped
+        task = self.event_tasks.get(evt.redacts or evt.content.redacts)
+        if task:
+            self.log.info(f"Cancelling links of redacted event {evt.redacts or evt.content.redacts}")
+            task.cancel()
+
+    async def get_post(self, platform, url_tup) -> Optional[ResolvedPost]:
+        # Concurrent requests for the same post share a single job and its result
+        link_key = (platform, ''.join(url_tup))
+        if self.missing_posts.get(link_key):
+            return None
+        try:
+            post_id = await self.get_post_id(platform, url_tup)
+        except PostNotFound as e:
+            return self.post_not_found(link_key, e)
+        key = (platform, post_id) if post_id else link_key
+        if self.missing_posts.get(key):
+            return None
+        task = self.inflight_posts.get(key)
+        if not task:
+            # The deadline covers the whole job, including the wait for a free worker
+            task = asyncio.create_task(asyncio.wait_for(self.fetch_post(platform, post_id, url_tup),
+                                                        self.config["timeouts.job"] or None))
+            self.inflight_posts[key] = task
+            task.add_done_callback(lambda _: self.forget_post(key, task))
+        # Shielded, so one waiter going away doesn't cancel the job for the others, but the job
+        # is cancelled once nobody waits for it anymore (e.g. all messages linking it were redacted)
+        self.post_waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except PostNotFound as e:
+            return self.post_not_found(key, e)
+        finally:
+            self.post_waiters[key] -= 1
+            if not self.post_waiters[key]:
+                del self.post_waiters[key]
+                if not task.done():
+                    task.cancel()
+                    self.forget_post(key, task)
+
+    async def get_post_id(self, platform, url_tup) -> Optional[str]:
+        post_id = canonical_post_id(platform, url_tup)
+        if not post_id and platform == "reddit":
+            # Share links are followed first, so they share the cache and the job with the post they point to
+            url = await self.get_redirected_url(f"https://www.reddit.com{url_tup[3]}")
+            match = re.search(r"/comments/([a-zA-Z0-9]+)", url or "")
+            post_id = match.group(1).lower() if match else None
+        return post_id
+
+    def post_not_found(self, key, e: PostNotFound) -> None:
+        self.log.info(f"Not sending {key[0]} post {key[1]}: {e}")
+        self.missing_posts.put(key, True)
+
+    def forget_post(self, key, task: asyncio.Task) -> None:
+        if self.inflight_posts.get(key) is task:
+            del self.inflight_posts[key]
+
+    async def fetch_post(self, platform, post_id, url_tup) -> Optional[ResolvedPost]:
+        async with self.scheduler.job(platform):
+            options = self.post_options(platform)
+            post = await self.load_post(platform, post_id, options) if post_id else None
+            if not post:
+                resolve = getattr(self, f"resolve_{platform}")
+                post = await resolve(url_tup)
+                if post and post_id and post.complete:
+                    await self.store_post(platform, post_id, options, post)
+            return post
+
+    def post_options(self, platform) -> str:
+        # What a resolved post contains depends on these options, so a post resolved with other
+        # values than the current ones isn't reused
+        names = [f"{platform}.{option}" for option in ("info", "image", "video", "thumbnail")]
+        names += ["download.max_pixels", "download.max_size"]
+        values = json.dumps([self.config.get(name, None) for name in names])
+        return hashlib.sha256(values.encode()).hexdigest()[:16]
+
+    async def load_post(self, platform, post_id, options) -> Optional[ResolvedPost]:
+        row = await self.database.fetchrow("SELECT info, info_html, media, fetched_at FROM resolved_post "
+                                           "WHERE platform=$1 AND post_id=$2 AND options=$3", platform, post_id, options)
+        if not row or time.time() - row["fetched_at"] > self.config["cache.post_ttl"]:
+            return None
+        return ResolvedPost.from_row(row)
+
+    async def store_post(self, platform, post_id, options, post: ResolvedPost):
+        info = post.info if post.lasting_info is None else post.lasting_info
+        info_html = post.info_html if post.lasting_info_html is None else post.lasting_info_html
+        await self.database.execute("INSERT INTO resolved_post (platform, post_id, options, info, info_html, media, fetched_at) "
+                                    "VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT (platform, post_id, options) DO UPDATE "
+                                    "SET info=excluded.info, info_html=excluded.info_html, media=excluded.media, "
+                                    "fetched_at=excluded.fetched_at",
+                                    platform, post_id, options, info, info_html, post.media_json(), int(time.time()))
+
+    @asynccontextmanager
+    async def upstream_request(self, upstream: str, method: str, url, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        # Connection errors, timeouts, rate limits and server errors count towards the upstream's
+        # circuit breaker, while it is open requests fail right away with CircuitOpen.
+        breaker = self.breakers[upstream]
+        breaker.check()
+        kwargs.setdefault("timeout", self.timeout("resolve"))
+        try:
+            async with self.http.request(method, url, **kwargs) as response:
+                breaker.record(response.status)
+                yield response
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.failure()
+            raise
+
+    @asynccontextmanager
+    async def fetch(self, url, retries: Optional[int] = None, upstream: Optional[str] = None, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        # GET for media downloads. Connection errors, timeouts and statuses like 503 are retried with
+        # exponential backoff and jitter (or as long as Retry-After asks), and slow requests are hedged.
+        # Yields the last response, whatever its status. Failures of the body are up to the caller.
+        breaker = self.breakers[upstream] if upstream else None
+        retries = max(0, self.config["download.retries"] if retries is None else retries)
+        kwargs.setdefault("timeout", self.timeout("download"))
+        for attempt in range(retries + 1):
+            if breaker:
+                breaker.check()
+            try:
+                response = await self.hedged_get(url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if breaker:
+                    breaker.failure()
+                if attempt == retries:
+                    raise
+                self.log.debug(f"Retrying {url} after {e!r}")
+                await asyncio.sleep(self.retry_delay(attempt))
+                continue
+            if breaker:
+                breaker.record(response.status)
+            delay = None
+            if response.status in RETRY_STATUSES and attempt < retries:
+                delay = self.retry_delay(attempt, response.headers.get("Retry-After"))
+            if delay is None:
+                break
+            self.log.debug(f"Retrying {url} after HTTP {response.status} in {delay:.1f}s")
+            response.close()
+            await asyncio.sleep(delay)
+
+        async with response:
+            try:
+                yield response
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if breaker:
+                    breaker.failure()
+                raise
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+        # Retry-After is either seconds or a date. None if the server wants us to wait too long.
+        if retry_after:
+            delay = float(retry_after) if retry_after.strip().isdigit() else None
+            if delay is None:
+                try:
+                    delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+            if delay is not None:
+                return max(0.0, delay) if delay <= self.config["download.max_retry_after"] else None
+        # Full jitter, so requests that failed together don't retry together
+        return random.uniform(0, self.config["download.backoff"] * 2 ** attempt)
+
+    async def hedged_get(self, url, **kwargs) -> aiohttp.ClientResponse:
+        # If the response takes longer than 95% of the recent requests to the same host did, a second
+        # request is sent, and whichever responds first is used. The other one is cancelled or closed.
+        host = yarl.URL(url).host
+        latency = self.fetch_latency.get(host)
+        if latency is None:
+            latency = LatencyTracker()
+            self.fetch_latency.put(host, latency)
+        threshold = latency.percentile(0.95) if self.config["download.hedge"] else None
+        loop = asyncio.get_running_loop()
+
+        async def request() -> aiohttp.ClientResponse:
+            start = loop.time()
+            response = await self.http.get(url, **kwargs)
+            latency.add(loop.time() - start)
+            return response
+
+        def discard(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                task.result().close()
+
+        tasks = [asyncio.create_task(request())]
+        try:
+            if threshold is not None:
+                done, _ = await asyncio.wait(tasks, timeout=threshold)
+                if not done:
+                    self.log.debug(f"Hedging request for {url} after {threshold:.2f}s")
+                    tasks.append(asyncio.create_task(request()))
+            response, error = None, None
+            while tasks and not response:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif response is None:
+                        response = task.result()
+                    else:
+                        discard(task)
+            if response is None:
+                raise error
+            return response
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(discard)
+
+    async def prune_posts(self):
+        while True:
+            await asyncio.sleep(self.config["cache.prune_interval"])
+            try:
+                await self.database.execute("DELETE FROM resolved_post WHERE fetched_at<$1",
+                                            int(time.time() - self.config["cache.post_ttl"]))
+            except Exception:
+                self.log.exception("Failed to prune resolved post cache")
+
+    async def send_post(self, evt, post: ResolvedPost):
+        if post.info_html:
+            await self.deadline("send", evt.reply(TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML, body=post.info or "", formatted_body=post.info_html)))
+        elif post.info:
+            await self.deadline("send", evt.reply(post.info))
+
+        for media in post.media:
+            if media.msgtype == MessageType.IMAGE:
+                await self.deadline("send", self.client.send_image(evt.room_id, url=media.uri, file_name=media.file_name, info=ImageInfo(mimetype=media.mimetype, size=media.size)))
+            else:
+                await self.deadline("send", self.client.send_file(evt.room_id, url=media.uri, info=BaseFileInfo(mimetype=media.mimetype, size=media.size), file_name=media.file_name, file_type=media.msgtype))
+
+    def timeout(self, stage: str) -> aiohttp.ClientTimeout:
+        # Stages are resolve, download, upload, send and job, 0 disables a deadline
+        return aiohttp.ClientTimeout(total=self.config[f"timeouts.{stage}"] or None)
+
+    async def deadline(self, stage: str, aw: Awaitable) -> Any:
+        return await asyncio.wait_for(aw, self.config[f"timeouts.{stage}"] or None)
 
     async def get_ttdownloader_params(self, tokensDict, url) -> list:
         cookies = {
@@ -99,59 +993,73 @@ class SocialMediaDownloadPlugin(Plugin):
         }
         return cookies, headers, data
         
-    def get_ttdownloader_tokens(self) -> dict:
-        tokens = {}
-        response = requests.get('https://ttdownloader.com/')
-        if response.status_code != 200:
-            self.log.warning(f"Unexpected status fetching tokens for ttdownloader.com: {response.status_code}")
-            return
-        
-        token_match = re.search(r'<input type="hidden" id="token" name="token" value="([^"]+)"', response.text)
-        token = token_match.group(1) if token_match else None
-        tokens["token"] = token
+    async def get_ttdownloader_tokens(self, refresh: bool = False) -> Optional[dict]:
+        # The PHPSESSID/token pair stays valid for a while, so it's only fetched again once it
+        # expires or ttdownloader.com stops accepting it.
+        async with self.ttdownloader_lock:
+            if not refresh and self.ttdownloader_tokens and time.monotonic() < self.ttdownloader_tokens_expiry:
+                return self.ttdownloader_tokens
 
-        for cookie in response.cookies:
-            tokens[cookie.name] = cookie.value
-        
-        return tokens
+            tokens = {}
+            async with self.upstream_request("ttdownloader.com", "GET", 'https://ttdownloader.com/') as response:
+                if response.status != 200:
+                    self.log.warning(f"Unexpected status fetching tokens for ttdownloader.com: {response.status}")
+                    return None
+                text = await response.text()
+                for name, cookie in response.cookies.items():
+                    tokens[name] = cookie.value
 
-    async def handle_tiktok(self, evt, url_tup):  
-        url = ''.join(url_tup)
+            token_match = re.search(r'<input type="hidden" id="token" name="token" value="([^"]+)"', text)
+            tokens["token"] = token_match.group(1) if token_match else None
+            if not tokens["token"] or "PHPSESSID" not in tokens:
+                self.log.warning("Failed to find tokens on ttdownloader.com")
+                self.breakers["ttdownloader.com"].failure()
+                return None
 
-        if self.config["tiktok.video"]:
-            loop = asyncio.get_running_loop()
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                tokensDict = await loop.run_in_executor(
-                pool, self.get_ttdownloader_tokens)
+            self.ttdownloader_tokens = tokens
+            self.ttdownloader_tokens_expiry = time.monotonic() + self.config["tiktok.token_ttl"]
+            return tokens
+
+    async def get_tiktok_download_url(self, url) -> Optional[str]:
+        for refresh in (False, True):
+            tokensDict = await self.get_ttdownloader_tokens(refresh)
+            if not tokensDict:
+                return None
 
             cookies, headers, data = await self.get_ttdownloader_params(tokensDict, url)
-            response = await self.http.post('https://ttdownloader.com/search/',cookies=cookies, headers=headers, data=data)
-            
-            if response.status != 200:
-                self.log.warning(f"Unexpected status sending download request to ttdownloader.com: {response.status}")
-                return
-            
-            href_values = re.findall(r'href="([^"]+)"', await response.text())
+            async with self.upstream_request("ttdownloader.com", "POST", 'https://ttdownloader.com/search/', cookies=cookies, headers=headers, data=data) as response:
+                if response.status != 200:
+                    self.log.warning(f"Unexpected status sending download request to ttdownloader.com: {response.status}")
+                    continue
+                href_values = re.findall(r'href="([^"]+)"', await response.text())
+
             valid_urls = [url for url in href_values if yarl.URL(url).scheme in ['http', 'https']]
-            response = await self.http.get(valid_urls[0])
-            
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching video for TikTok URL {url_tup}: {response.status}")
-                return
+            if valid_urls:
+                return valid_urls[0]
+            self.log.warning(f"No download link in ttdownloader.com response for {url}")
+        return None
+
+    async def resolve_tiktok(self, url_tup) -> Optional[ResolvedPost]:
+        url = ''.join(url_tup)
+        post_id = canonical_post_id("tiktok", url_tup)
+        post = ResolvedPost()
 
-            media = await response.read()
+        if self.config["tiktok.video"]:
             mime_type = 'video/mp4'
             file_extension = ".mp4"
-            file_name = str(hash(url)) + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-            await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)     
+            file_name = post_file_name(post_id, file_extension)
+            cache_url = canonical_url("tiktok", post_id)
+            cached = self.upload_cache.get(f"url:{cache_url}")
+            if cached:
+                post.media.append(PostMedia(cached.uri, cached.mimetype, cached.size, file_name, MessageType.VIDEO))
+                return post
 
-    async def get_youtube_video_id(self, url):
-        if "youtu.be" in url:
-            video_id = url.split("youtu.be/")[1]
-        else:
-            video_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['v'][0]
-        return video_id.split("?", 1)[0]
+            download_url = await self.get_tiktok_download_url(url)
+            if not download_url:
+                return None
+            await self.add_media(post, MessageType.VIDEO, download_url, mime_type, file_name, cache_url=cache_url)
+
+        return post
 
     async def generate_youtube_query_url(self, url):
         params = {"format": "json", "url": url}
@@ -159,256 +1067,663 @@ class SocialMediaDownloadPlugin(Plugin):
         query_string = urllib.parse.urlencode(params)
         return f"{query_url}?{query_string}"
 
-    async def handle_youtube(self, evt, url_tup):
-        url = ''.join(url_tup)
-        video_id = await self.get_youtube_video_id(url)
-
-        query_url = await self.generate_youtube_query_url(url)
-        response = await self.http.get(query_url)
-        if response.status != 200:
-            self.log.warning(f"Unexpected status fetching video title {query_url}: {response.status}")
-            return
+    async def get_youtube_oembed(self, video_id) -> Optional[dict]:
+        data = self.youtube_oembed.get(video_id)
+        if data:
+            return data
 
-        response_text = await response.read()
+        query_url = await self.generate_youtube_query_url(canonical_url("youtube", video_id))
+        async with self.http.get(query_url, timeout=self.timeout("resolve")) as response:
+            if response.status == 404:
+                raise PostNotFound(f"YouTube video {video_id} does not exist")
+            if response.status != 200:
+                self.log.warning(f"Unexpected status fetching video title {query_url}: {response.status}")
+                return None
+            response_text = await response.read()
         data = json.loads(response_text.decode())
+        self.youtube_oembed.put(video_id, data)
+        return data
+
+    async def resolve_youtube(self, url_tup) -> Optional[ResolvedPost]:
+        video_id = youtube_video_id(url_tup)
+        if not video_id:
+            self.log.warning(f"No video ID in YouTube link {''.join(url_tup)}")
+            return None
+        thumbnail = ResolvedPost()
+
+        # The thumbnail URL only depends on the video ID, so it's fetched while waiting for the title
+        async def add_thumbnail():
+            if self.config["youtube.thumbnail"]:
+                thumbnail_link = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
+                await self.add_media(thumbnail, MessageType.IMAGE, thumbnail_link, 'image/jpeg', f"{video_id}.jpg")
+
+        thumbnail_task = asyncio.create_task(add_thumbnail())
+        try:
+            data = await self.get_youtube_oembed(video_id)
+        except BaseException:
+            # Without the video's data nothing is sent, so the thumbnail doesn't need to be finished
+            thumbnail_task.cancel()
+            raise
+        if not data:
+            thumbnail_task.cancel()
+            return None
+        # A failed thumbnail only leaves the thumbnail out, the title is still sent
+        [error] = await asyncio.gather(thumbnail_task, return_exceptions=True)
+        if isinstance(error, BaseException):
+            self.log.warning(f"Failed to fetch thumbnail of YouTube video {video_id}: {error!r}")
+            thumbnail.complete = False
+        post = ResolvedPost(media=thumbnail.media, complete=thumbnail.complete)
 
         if self.config["youtube.info"]:
-            await evt.reply(data['title'])
+            post.info = data['title']
 
-        if self.config["youtube.thumbnail"]:
-            thumbnail_link = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-            response = await self.http.get(thumbnail_link)
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching image {thumbnail_link}: {response.status}")
-                return
-            thumbnail = await response.read()
-            filename = f"{video_id}.jpg"
-            uri = await self.client.upload_media(thumbnail, mime_type='image/jpeg', filename=filename)
-            await self.client.send_image(evt.room_id, url=uri, file_name=filename, info=ImageInfo(mimetype='image/jpeg'))
+        return post
+
+    def fetch_instagram_post(self, shortcode: str) -> InstagramPostInfo:
+        post = instaloader.Post.from_shortcode(self.instaloader.context, shortcode)
+        # Every property below may trigger further (blocking) requests, so read them all here.
+        return InstagramPostInfo(
+            owner_username=post.owner_username,
+            caption=post.caption,
+            caption_hashtags=post.caption_hashtags,
+            caption_mentions=post.caption_mentions,
+            likes=post.likes,
+            comments=post.comments,
+            is_video=post.is_video,
+            url=post.url,
+            video_url=post.video_url if post.is_video else None,
+        )
+
+    async def resolve_instagram_post(self, shortcode: str) -> Optional[InstagramPostInfo]:
+        # Jobs are limited to the number of workers, so lookups only pile up in the executor if jobs gave up
+        # on them (timed out or redacted) while Instaloader keeps working on them
+        if self.instagram_jobs >= max(1, self.config["instagram.workers"]):
+            self.log.warning(f"All Instagram workers are busy with abandoned lookups ({self.instagram_jobs}), dropping {shortcode}")
+            return None
+
+        breaker = self.breakers["instagram.com"]
+        breaker.check()
+        # Counted until the thread is done with it, not until we stop waiting for it, so lookups that
+        # were given up on still take their place in the executor's (unbounded) queue
+        loop = asyncio.get_running_loop()
+        future = self.instagram_executor.submit(self.fetch_instagram_post, shortcode)
+        self.instagram_jobs += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.instagram_job_done))
+        try:
+            info = await asyncio.wrap_future(future)
+        except instaloader.QueryReturnedNotFoundException as e:
+            breaker.success()
+            raise PostNotFound(f"Instagram post {shortcode} does not exist") from e
+        except instaloader.InstaloaderException as e:
+            breaker.failure()
+            self.log.warning(f"Failed to fetch instagram post {shortcode}: {e}")
+            return None
+        breaker.success()
+        return info
+
+    def instagram_job_done(self) -> None:
+        self.instagram_jobs -= 1
 
-    async def handle_instagram(self, evt, url_tup):
-        L = instaloader.Instaloader(user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36")
+    async def resolve_instagram(self, url_tup) -> Optional[ResolvedPost]:
         shortcode = url_tup[5]
-        self.log.warning(shortcode)
-        post = instaloader.Post.from_shortcode(L.context, shortcode)
+        info = await self.resolve_instagram_post(shortcode)
+        if not info:
+            return None
+        post = ResolvedPost()
 
         if self.config["instagram.info"]:
-            await evt.reply(TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML, formatted_body=f"""<p>Username: {post.owner_username}<br>Caption: {post.caption}<br>Hashtags: {post.caption_hashtags}<br>Mentions: {post.caption_mentions}<br>Likes: {post.likes}<br>Comments: {post.comments}</p>"""))
+            lines = [f"Username: {info.owner_username}", f"Caption: {info.caption}",
+                     f"Hashtags: {info.caption_hashtags}", f"Mentions: {info.caption_mentions}"]
+            # Likes and comments are only sent with a freshly fetched post, a stored one would show outdated numbers
+            counts = [f"Likes: {info.likes}", f"Comments: {info.comments}"]
+            post.info = "\n".join(lines + counts)
+            post.info_html = f"<p>{'<br>'.join(lines + counts)}</p>"
+            post.lasting_info = "\n".join(lines)
+            post.lasting_info_html = f"<p>{'<br>'.join(lines)}</p>"
 
-        if (post.is_video and self.config["instagram.thumbnail"]) or (not post.is_video and self.config["instagram.image"]):
-            response = await self.http.get(post.url)
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching instagram image {post.url}: {response.status}")
-                return
+        if (info.is_video and self.config["instagram.thumbnail"]) or (not info.is_video and self.config["instagram.image"]):
+            # The CDN URLs are signed and change between fetches, so cache by shortcode instead
+            await self.add_media(post, MessageType.IMAGE, info.url, 'image/jpeg', shortcode + ".jpg", cache_url=f"{canonical_url('instagram', shortcode)}#image")
+            if not post.complete:
+                return post
+
+        if info.is_video and self.config["instagram.video"]:
+            # Without the thumbnail option, the thumbnail is only sent if the video is too large
+            await self.add_media(post, MessageType.VIDEO, yarl.URL(info.video_url, encoded=True), 'video/mp4', shortcode + ".mp4",
+                                 cache_url=f"{canonical_url('instagram', shortcode)}#video",
+                                 thumbnail_url=None if self.config["instagram.thumbnail"] else info.url)
+
+        return post
 
-            media = await response.read()
-            mime_type = 'image/jpeg'
-            file_extension = ".jpg"
-            file_name = shortcode + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-            self.log.warning(f"{mime_type} {file_name}")
-            await self.client.send_image(evt.room_id, url=uri, file_name=file_name, info=ImageInfo(mimetype='image/jpeg'))
+    async def get_redirected_url(self, short_url: str) -> Optional[str]:
+        url = self.reddit_redirects.get(short_url)
+        if url:
+            return url
 
-        if post.is_video and self.config["instagram.video"]:
-            response = await self.http.get(yarl.URL(post.video_url,encoded=True))
+        # Follow the redirects with HEAD requests, the target is in the headers and the page itself isn't needed
+        url = short_url
+        headers = {'User-Agent': 'ggogel/SocialMediaDownloadMaubot'}
+        for _ in range(5):
+            async with self.http.head(url, headers=headers, allow_redirects=False, timeout=self.timeout("resolve")) as response:
+                if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+                    url = urljoin(url, response.headers["Location"])
+                    continue
+                status = response.status
+                break
+        else:
+            self.log.warning(f"Too many redirects resolving {short_url}")
+            return None
+
+        if status == 405:
+            # HEAD not allowed, fall back to GET but stop after the headers
+            async with self.http.get(url, headers=headers, allow_redirects=True, timeout=self.timeout("resolve")) as response:
+                status, url = response.status, str(response.url)
+        if status in (404, 410):
+            raise PostNotFound(f"{short_url} returned HTTP {status}")
+        if status != 200:
+            self.log.warning(f"Unexpected status fetching redirected URL: {status}")
+            return None
+
+        url = url.split('?')[0]
+        self.reddit_redirects.put(short_url, url)
+        return url
+
+
+    async def upload_cached(self, data: AsyncIterator[bytes], mime_type, file_name, cache_url, size: int, digest: str) -> UploadedMedia:
+        hash_key = f"sha256:{digest}"
+        media = self.upload_cache.get(hash_key)
+        if not media:
+            uri = await self.deadline("upload", self.client.upload_media(data, mime_type=mime_type, filename=file_name, size=size))
+            media = UploadedMedia(uri=uri, mimetype=mime_type, size=size)
+            self.upload_cache.put(hash_key, media)
+        if cache_url:
+            self.upload_cache.put(f"url:{cache_url}", media)
+        return media
+
+    async def fetch_and_upload(self, media_url, mime_type, file_name, cache_url=None, upstream=None) -> Optional[UploadedMedia]:
+        # upstream is the name of the circuit breaker of services like rapidsave.com
+        cache_url = cache_url or str(media_url)
+        media = self.upload_cache.get(f"url:{cache_url}")
+        if media:
+            return media
+
+        async with self.fetch(media_url, upstream=upstream) as response:
             if response.status != 200:
-                self.log.warning(f"Unexpected status fetching instagram video {post.video_url}: {response.status}")
-                return
+                self.log.warning(f"Unexpected status fetching media {media_url}: {response.status}")
+                return None
+            return await self.upload_response(response, mime_type, file_name, cache_url)
 
-            media = await response.read()
-            mime_type = 'video/mp4'
-            file_extension = ".mp4"
-            file_name = shortcode + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-            await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)
-
-    async def get_redirected_url(self, short_url: str) -> str:
-        async with self.http.get(short_url, allow_redirects=True) as response:
-            if response.status == 200:
-                return str(response.url)
-            else:
-                self.log.warning(f"Unexpected status fetching redirected URL: {response.status}")
+    async def upload_response(self, response, mime_type, file_name, cache_url) -> Optional[UploadedMedia]:
+        # Media the homeserver would reject anyway is given up on as soon as that is known, before
+        # it waits for its share of the transfer budget
+        upload_limit = await self.get_upload_limit()
+        if upload_limit and response.content_length and response.content_length > upload_limit:
+            raise MediaTooLarge(f"{response.url} is {response.content_length} bytes, the upload limit is {upload_limit}")
+        async with self.scheduler.transfer(response.content_length or self.config["download.spool_size"]):
+            return await self._upload_response(response, mime_type, file_name, cache_url, upload_limit)
+
+    async def _upload_response(self, response, mime_type, file_name, cache_url, upload_limit: int) -> Optional[UploadedMedia]:
+        digest = hashlib.sha256()
+        chunks = iter_hashed(response.content.iter_chunked(CHUNK_SIZE), digest)
+
+        # With a known length the body is piped straight into the upload. aiohttp decompresses
+        # encoded bodies, in which case Content-Length is not the length of what we read.
+        size = response.content_length
+        if size and response.headers.get("Content-Encoding", "identity") == "identity":
+            uri = await self.deadline("upload", self.client.upload_media(chunks, mime_type=mime_type, filename=file_name, size=size))
+            media = UploadedMedia(uri=uri, mimetype=mime_type, size=size)
+            self.upload_cache.put(f"sha256:{digest.hexdigest()}", media)
+            self.upload_cache.put(f"url:{cache_url}", media)
+            return media
+
+        with tempfile.SpooledTemporaryFile(max_size=self.config["download.spool_size"]) as spool:
+            async for chunk in chunks:
+                spool.write(chunk)
+                if upload_limit and spool.tell() > upload_limit:
+                    raise MediaTooLarge(f"{response.url} exceeds the upload limit of {upload_limit} bytes")
+            size = spool.tell()
+            if size == 0:
+                self.log.warning(f"Received 0 bytes when fetching media {response.url}")
                 return None
-            
-    async def send_image(self, evt, media_url, mime_type, file_name):
-        response = await self.http.get(media_url)
-        if response.status != 200:
-            self.log.warning(f"Unexpected status fetching media {media_url}: {response.status}")
+            spool.seek(0)
+            return await self.upload_cached(iter_file(spool), mime_type, file_name, cache_url, size=size, digest=digest.hexdigest())
+
+    async def get_upload_limit(self) -> int:
+        # Queried once, 0 if the homeserver doesn't announce a limit
+        if self.upload_limit is None:
+            try:
+                media_config = await self.client.get_media_repo_config()
+            except Exception as e:
+                self.log.warning(f"Failed to fetch media repository config: {e}")
+                return 0
+            self.upload_limit = media_config.upload_size or 0
+        return self.upload_limit
+
+    async def get_max_size(self) -> int:
+        # The smaller of download.max_size and the upload limit, 0 if neither is set
+        upload_limit = await self.get_upload_limit()
+        return min((limit for limit in (self.config["download.max_size"], upload_limit) if limit), default=0)
+
+    async def add_media(self, post: ResolvedPost, msgtype, media_url, mime_type, file_name, cache_url=None, thumbnail_url=None):
+        # thumbnail_url is sent instead of media that is too large for the homeserver
+        try:
+            media = await self.fetch_and_upload(media_url, mime_type, file_name, cache_url)
+        except MediaTooLarge as e:
+            self.log.info(f"Not sending {file_name}: {e}")
+            if thumbnail_url:
+                await self.add_thumbnail(post, thumbnail_url, file_name)
             return
+        except MEDIA_ERRORS as e:
+            # The rest of the post (like its info) is still sent
+            self.log.warning(f"Failed to fetch {file_name}: {e!r}")
+            media = None
+        if media:
+            post.media.append(PostMedia(media.uri, media.mimetype, media.size, file_name, msgtype))
+        else:
+            post.complete = False
 
-        media = await response.read()
-        uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-        await self.client.send_image(evt.room_id, url=uri, file_name=file_name, info=ImageInfo(mimetype=mime_type))
+    async def add_thumbnail(self, post: ResolvedPost, thumbnail_url, file_name):
+        mime_type = mimetypes.guess_type(str(thumbnail_url).split("?")[0])[0] or "image/jpeg"
+        thumbnail_name = os.path.splitext(file_name)[0] + "_thumbnail" + (mimetypes.guess_extension(mime_type) or ".jpg")
+        await self.add_media(post, MessageType.IMAGE, thumbnail_url, mime_type, thumbnail_name)
 
-    async def handle_reddit(self, evt, url_tup):
-        url = ''.join(url_tup).split('?')[0]
+    async def add_gallery(self, post: ResolvedPost, items: List[Tuple[MessageType, str, str, str]]):
+        # items are (msgtype, media_url, mime_type, file_name). They are downloaded and uploaded
+        # concurrently, but added to the post in their original order.
+        semaphore = asyncio.Semaphore(max(1, self.config["download.gallery_concurrency"]))
 
-        if "/s/" in url:
-            url = await self.get_redirected_url(url)
-            if not url:
-                return
+        async def upload(media_url, mime_type, file_name) -> Optional[UploadedMedia]:
+            async with semaphore:
+                return await self.fetch_and_upload(media_url, mime_type, file_name)
+
+        uploads = await asyncio.gather(*(upload(media_url, mime_type, file_name) for _, media_url, mime_type, file_name in items),
+                                       return_exceptions=True)
+        for (msgtype, _, _, file_name), media in zip(items, uploads):
+            if isinstance(media, MediaTooLarge):
+                self.log.info(f"Not sending {file_name}: {media}")
+            elif isinstance(media, MEDIA_ERRORS):
+                self.log.warning(f"Failed to fetch {file_name}: {media!r}")
+                post.complete = False
+            elif isinstance(media, BaseException):
+                raise media
+            elif media:
+                post.media.append(PostMedia(media.uri, media.mimetype, media.size, file_name, msgtype))
+            else:
+                post.complete = False
+
+    async def download_to_file(self, url: str, path: str, max_size: int = 0) -> bool:
+        async with self.fetch(url) as response:
+            if response.status != 200:
+                self.log.warning(f"Unexpected status fetching media {url}: {response.status}")
+                return False
+            if max_size and response.content_length and response.content_length > max_size:
+                raise MediaTooLarge(f"{url} is {response.content_length} bytes, the upload limit is {max_size}")
+            with open(path, "wb") as file:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    file.write(chunk)
+                    if max_size and file.tell() > max_size:
+                        raise MediaTooLarge(f"{url} exceeds the upload limit of {max_size} bytes")
+        return True
+
+    async def download_reddit_dash(self, dash_url: str, file_name, cache_url) -> Optional[UploadedMedia]:
+        async with self.http.get(dash_url, timeout=self.timeout("resolve")) as response:
+            if response.status != 200:
+                self.log.warning(f"Unexpected status fetching DASH manifest {dash_url}: {response.status}")
+                return None
+            manifest_text = await response.text()
+        try:
+            manifest = parse_dash_manifest(manifest_text, dash_url)
+        except (ElementTree.ParseError, ValueError) as e:
+            self.log.warning(f"Failed to parse DASH manifest {dash_url}: {e}")
+            return None
+
+        upload_limit = await self.get_upload_limit()
+        max_size = await self.get_max_size()
+        audio = choose_rendition(manifest.audios)
+        audio_size = audio.bandwidth * manifest.duration / 8 if audio else 0
+        # What is left for the video once the audio is in, but never 0, which would mean no limit
+        video_budget = max(1, max_size - audio_size) if max_size else 0
+        video = choose_rendition(manifest.videos, self.config["download.max_pixels"], video_budget, manifest.duration)
+        if not video:
+            self.log.warning(f"No video representation in DASH manifest {dash_url}")
+            return None
+        estimated_size = int(video.bandwidth * manifest.duration / 8 + audio_size)
+        if upload_limit and estimated_size > upload_limit:
+            raise MediaTooLarge(f"{dash_url} is about {estimated_size} bytes, the upload limit is {upload_limit}")
 
-        url = await self.get_redirected_url(url)
-        query_url = quote(url).replace('%3A', ':') + ".json" + "?limit=1"
+        with tempfile.TemporaryDirectory(prefix="socialmediadownload-") as tmpdir:
+            streams = [(video.url, os.path.join(tmpdir, "video.mp4"))]
+            if audio:
+                streams.append((audio.url, os.path.join(tmpdir, "audio.mp4")))
+            output = os.path.join(tmpdir, file_name)
+
+            async with self.scheduler.transfer(estimated_size):
+                results = await asyncio.gather(*(self.download_to_file(url, path, upload_limit) for url, path in streams))
+            if not all(results):
+                return None
+
+            # Both streams are already mp4, so they are only remuxed, not re-encoded
+            args = [self.ffmpeg, "-nostdin", "-loglevel", "error", "-y"]
+            for _, path in streams:
+                args += ["-i", path]
+            args += ["-c", "copy", "-movflags", "+faststart", output]
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                # Don't leave ffmpeg writing into the directory that is about to be removed, and reap it
+                if process.returncode is None:
+                    process.kill()
+                await asyncio.shield(process.wait())
+                raise
+            if process.returncode != 0:
+                self.log.warning(f"ffmpeg failed to mux {dash_url}: {stderr.decode(errors='replace').strip()}")
+                return None
+
+            digest = hashlib.sha256()
+            with open(output, "rb") as file:
+                async for chunk in iter_file(file):
+                    digest.update(chunk)
+                size = file.tell()
+                if upload_limit and size > upload_limit:
+                    raise MediaTooLarge(f"{dash_url} is {size} bytes, the upload limit is {upload_limit}")
+                file.seek(0)
+                return await self.upload_cached(iter_file(file), "video/mp4", file_name, cache_url, size=size, digest=digest.hexdigest())
+
+    def choose_reddit_image(self, media_info: dict) -> str:
+        # 's' is the original, 'p' are downscaled previews that are only used if the original is too big
+        source = media_info['s']
+        renditions = [Rendition(url=source['u'].replace("preview", "i"), width=source.get('x', 0), height=source.get('y', 0))]
+        renditions += [Rendition(url=html.unescape(preview['u']), width=preview.get('x', 0), height=preview.get('y', 0))
+                       for preview in media_info.get('p', [])]
+        return choose_rendition(renditions, self.config["download.max_pixels"]).url
+
+    async def fetch_reddit_posts(self, post_ids: List[str]) -> Dict[str, dict]:
+        # by_id returns just the listing of the posts, without the comments of a permalink request
+        names = ",".join(f"t3_{post_id}" for post_id in post_ids)
+        query_url = f"https://www.reddit.com/by_id/{names}.json"
         headers = {'User-Agent': 'ggogel/SocialMediaDownloadMaubot'}
-        response = await self.http.request('GET', query_url, headers=headers)
+        async with self.http.get(query_url, headers=headers, timeout=self.timeout("resolve")) as response:
+            if response.status != 200:
+                # Raised instead of returning no posts, which would mean that none of them exist
+                self.log.warning(f"Unexpected status fetching reddit listing {query_url}: {response.status}")
+                response.raise_for_status()
+            data = await response.json()
+        return {child['data']['id']: child['data'] for child in data['data']['children']}
 
-        if response.status != 200:
-            self.log.warning(f"Unexpected status fetching reddit listing {query_url}: {response.status}")
-            return
+    async def resolve_reddit(self, url_tup) -> Optional[ResolvedPost]:
+        if "/comments/" in url_tup[3]:
+            # Already canonical, no need to ask reddit where it points to
+            url = f"https://www.reddit.com{url_tup[3]}"
+        else:
+            url = await self.get_redirected_url(f"https://www.reddit.com{url_tup[3]}")
+            if not url:
+                return None
 
-        response_text = await response.read()
-        data = json.loads(response_text.decode())
-        post_data = data[0]['data']['children'][0]['data']
+        match = re.search(r"/comments/([a-zA-Z0-9_\-]+)", url)
+        if not match:
+            self.log.warning(f"Unable to find post ID in reddit URL {url}")
+            return None
+        # by_id returns the IDs in lower case, whatever case the link used
+        post_id = match.group(1).lower()
+        try:
+            post_data = await self.reddit_posts.get(post_id)
+        except aiohttp.ClientError as e:
+            self.log.warning(f"Failed to fetch reddit post {url}: {e!r}")
+            return None
+        if not post_data:
+            # The listing was fetched, but doesn't contain the post
+            raise PostNotFound(f"reddit post {post_id} does not exist")
         sub, title, name = post_data['subreddit_name_prefixed'], post_data['title'], post_data['name']
 
+        post = ResolvedPost()
+
         if self.config["reddit.info"]:
-            await evt.reply(TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML, body=f"{sub}: {title}", formatted_body=f"""<p><b>{sub}: {title}</b></p>"""))
+            post.info = f"{sub}: {title}"
+            post.info_html = f"""<p><b>{sub}: {title}</b></p>"""
 
         if 'url_overridden_by_dest' in post_data:
             media_url = post_data['url_overridden_by_dest']
             mime_type = mimetypes.guess_type(media_url)[0]
 
+            reddit_video = None
             if mime_type is None:
                 if 'is_gallery' in post_data and post_data['is_gallery']:
+                    items = []
                     for media_id, media_info in post_data['media_metadata'].items():
-                        media_url = (media_info['s']['u']).replace("preview", "i")
+                        media_url = self.choose_reddit_image(media_info)
                         mime_type = media_info['m']
                         file_extension = mimetypes.guess_extension(mime_type, strict=False)
                         file_name = f"{media_id}{file_extension or ''}"
-                        await self.send_image(evt, media_url, mime_type, file_name)
-                    return
-                elif 'secure_media' in post_data and 'reddit_video' in post_data['secure_media']:
-                    fallback_url = post_data['secure_media']['reddit_video']['fallback_url']
-                elif 'preview' in post_data and 'reddit_video_preview' in post_data['preview']:
-                    fallback_url = post_data['preview']['reddit_video_preview']['fallback_url']
+                        items.append((MessageType.IMAGE, media_url, mime_type, file_name))
+                    await self.add_gallery(post, items)
+                    return post
+                elif 'reddit_video' in (post_data.get('secure_media') or {}):
+                    reddit_video = post_data['secure_media']['reddit_video']
+                elif 'reddit_video_preview' in (post_data.get('preview') or {}):
+                    reddit_video = post_data['preview']['reddit_video_preview']
                 else:
-                    self.log.warning(f"Unable to determine media url for {query_url}")
-                    return
+                    self.log.warning(f"Unable to determine media url for {url}")
+                    return post
                 
-                media_url = fallback_url.split('?')[0]
+                media_url = reddit_video['fallback_url'].split('?')[0]
                 mime_type = mimetypes.guess_type(media_url)[0]
 
             file_extension = mimetypes.guess_extension(mime_type, strict=False)
             file_name = name + file_extension
 
             if "image" in mime_type and self.config["reddit.image"]:
-                await self.send_image(evt, media_url, mime_type, file_name)
+                await self.add_media(post, MessageType.IMAGE, media_url, mime_type, file_name)
 
             elif "video" in mime_type and self.config["reddit.video"]:
-                audio_url = media_url.replace("DASH_720", "DASH_audio")
-                url = urllib.parse.quote(url)
-                download_url = f"https://sd.rapidsave.com/download.php?permalink={url}&video_url={media_url}?source=fallback&audio_url={audio_url}?source=fallback"
-                response = await self.http.get(download_url)
+                try:
+                    media = self.upload_cache.get(f"url:{media_url}")
+                    if not media and reddit_video and reddit_video.get('dash_url') and self.ffmpeg:
+                        media = await self.download_reddit_dash(reddit_video['dash_url'], file_name, cache_url=media_url)
+                    if not media:
+                        audio_url = media_url.replace("DASH_720", "DASH_audio")
+                        url = urllib.parse.quote(url)
+                        download_url = f"https://sd.rapidsave.com/download.php?permalink={url}&video_url={media_url}?source=fallback&audio_url={audio_url}?source=fallback"
+                        media = await self.fetch_and_upload(download_url, mime_type, file_name, cache_url=media_url, upstream="sd.rapidsave.com")
+                except CircuitOpen as e:
+                    self.log.warning(f"Not downloading {file_name}: {e}")
+                    media = None
+                except MEDIA_ERRORS as e:
+                    self.log.warning(f"Failed to fetch {file_name}: {e!r}")
+                    media = None
+                except MediaTooLarge as e:
+                    self.log.info(f"Not sending {file_name}: {e}")
+                    previews = (post_data.get('preview') or {}).get('images') or [{}]
+                    thumbnail_url = previews[0].get('source', {}).get('url')
+                    if thumbnail_url:
+                        await self.add_thumbnail(post, html.unescape(thumbnail_url), file_name)
+                    return post
+                if media:
+                    post.media.append(PostMedia(media.uri, media.mimetype, media.size, file_name, MessageType.VIDEO))
+                else:
+                    post.complete = False
 
-                if response.status != 200:
-                    self.log.warning(f"Unexpected status fetching media {download_url}: {response.status}")
-                    return
+            elif self.config["reddit.image"] or self.config["reddit.video"]:
+                self.log.warning(f"Unknown media type {url}: {mime_type}")
 
-                media = await response.read()
+        return post
 
-                if len(media) == 0:
-                    self.log.warning(f"Received 0 bytes when fetching media {download_url}")
-                    return
+    async def resolve_bluesky_handle(self, user: str) -> Optional[str]:
+        if user.startswith("did:"):
+            return user
+        did = self.bluesky_dids.get(user)
+        if not did:
+            did = await self.bluesky_handles.get(user)
+            if not did:
+                return None
+            self.bluesky_dids.put(user, did)
+            self.log.info(f"Resolved Bluesky handle {user} to DID {did}")
+        return did
+
+    async def fetch_bluesky_dids(self, users: List[str]) -> Dict[str, str]:
+        # There is no batch endpoint for handles, but the batcher still merges lookups of the same handle
+        async def resolve(user: str) -> Optional[str]:
+            did_url = "https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle"
+            async with self.upstream_request("public.api.bsky.app", "GET", did_url, params={"handle": user}) as response:
+                if response.status != 200:
+                    self.log.warning(f"Failed to resolve handle {user}: HTTP {response.status}")
+                    return None
+                did_data = await response.json()
+            did = did_data.get("did")
+            if not did:
+                self.log.warning(f"No DID found for handle {user}")
+            return did
 
-                uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-                await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)
+        dids = await asyncio.gather(*(resolve(user) for user in users))
+        return {user: did for user, did in zip(users, dids) if did}
 
-            elif self.config["reddit.image"] or self.config["reddit.video"]:
-                self.log.warning(f"Unknown media type {query_url}: {mime_type}")
-                return
+    async def fetch_bluesky_posts(self, uris: List[str]) -> Dict[str, dict]:
+        post_url = "https://public.api.bsky.app/xrpc/app.bsky.feed.getPosts"
+        async with self.upstream_request("public.api.bsky.app", "GET", post_url, params=[("uris", uri) for uri in uris]) as response:
+            if response.status != 200:
+                # Raised instead of returning no posts, which would mean that none of them exist
+                self.log.warning(f"Failed to fetch posts {uris}: HTTP {response.status}")
+                response.raise_for_status()
+            post_data = await response.json()
+        return {post["uri"]: post for post in post_data.get("posts", [])}
 
-    async def handle_bluesky(self, evt, url_tup):
+    async def resolve_bluesky(self, url_tup) -> Optional[ResolvedPost]:
         # Get user and post ID from the URL
         url = ''.join(url_tup)
         user, post_id = url.split("/")[-3], url.split("/")[-1]
         
         # Get the DID of the user
-        did_url = f"https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={user}"
-        async with self.http.get(did_url) as response:
-            if response.status != 200:
-                self.log.warning(f"Failed to resolve handle {user}: HTTP {response.status}")
-                return
-            did_data = await response.json()
-            did = did_data.get("did")
-            if not did:
-                self.log.warning(f"No DID found for handle {user}")
-                return
-            
-        self.log.info(f"Resolved Bluesky handle {user} to DID {did}")
-            
+        did = await self.resolve_bluesky_handle(user)
+        if not did:
+            return None
+
         # Get the post using the DID and post ID and Bluesky's public relay API
-        post_url = f"https://public.api.bsky.app/xrpc/app.bsky.feed.getPosts?uris=at://{did}/app.bsky.feed.post/{post_id}"
-        async with self.http.get(post_url) as response:
-            if response.status != 200:
-                self.log.warning(f"Failed to fetch post {post_id}: HTTP {response.status}")
-                return
-            post_data = await response.json()
-            post = post_data.get("posts", [])[0]
-            if not post:
-                self.log.warning(f"No post found for ID {post_id}")
-                return
-            
-            content = post.get("record", {}).get("text", "")
-            if content and self.config["bluesky.info"]:
-                await evt.reply(TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML, body=content, formatted_body=content))
-
-            # Handle attachments
-            embed = post.get("embed", {})
-            if embed:
-                if "images" in embed:
-                    # We'll use the fullsize image if available, otherwise the thumbnail
-                    for image in embed["images"]:
-                        fullsize = image.get("fullsize")
-                        thumb = image.get("thumb")
-                        alt = image.get("alt", "Bluesky Image")
-                        if fullsize:
-                            media_url = fullsize
-                        elif thumb:
-                            media_url = thumb
-                        else:
-                            # Are there other types of images that could be found?
-                            continue
-                        
-                        mime_type = mimetypes.guess_type(media_url)[0] or "image/jpeg"
-                        file_name = f"{post_id}_image.jpg"
-                        await self.send_image(evt, media_url, mime_type, file_name)
-                elif "playlist" in embed:
-                    playlist_url = embed["playlist"]
-                    thumbnail_url = embed.get("thumbnail")
-                    self.log.info(f"Video URL: {playlist_url}, Thumbnail URL: {thumbnail_url}")
-                    
-                    if playlist_url and self.config["bluesky.video"]:
-                        media_bytes = await self.download_m3u8_file(playlist_url)
-                        if not media_bytes:
-                            self.log.warning(f"Failed to download video from {playlist_url}")
-                            return
-                        
-                        mime_type = "video/mp4"
-                        file_name = f"{post_id}_video.mp4"
-                        uri = await self.client.upload_media(media_bytes, mime_type=mime_type, filename=file_name)
-                        await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media_bytes)), file_name=file_name, file_type=MessageType.VIDEO)
+        try:
+            bsky_post = await self.bluesky_posts.get(f"at://{did}/app.bsky.feed.post/{post_id}")
+        except aiohttp.ClientError as e:
+            self.log.warning(f"Failed to fetch Bluesky post {post_id}: {e!r}")
+            return None
+        if not bsky_post:
+            # getPosts leaves out posts that don't exist (or were deleted)
+            raise PostNotFound(f"Bluesky post {user}/{post_id} does not exist")
+        post = ResolvedPost()
+
+        content = bsky_post.get("record", {}).get("text", "")
+        if content and self.config["bluesky.info"]:
+            post.info = content
+            post.info_html = content
+
+        # Handle attachments
+        embed = bsky_post.get("embed", {})
+        if embed:
+            if "images" in embed:
+                # We'll use the fullsize image if available, otherwise the thumbnail
+                items = []
+                for image in embed["images"]:
+                    fullsize = image.get("fullsize")
+                    thumb = image.get("thumb")
+                    alt = image.get("alt", "Bluesky Image")
+                    aspect_ratio = image.get("aspectRatio") or {}
+                    max_pixels = self.config["download.max_pixels"]
+                    if thumb and max_pixels and aspect_ratio.get("width", 0) * aspect_ratio.get("height", 0) > max_pixels:
+                        media_url = thumb
+                    elif fullsize:
+                        media_url = fullsize
+                    elif thumb:
+                        media_url = thumb
+                    else:
+                        # Are there other types of images that could be found?
+                        continue
                     
-                    if thumbnail_url and self.config["bluesky.thumbnail"]:
-                        mime_type = mimetypes.guess_type(thumbnail_url)[0] or "image/jpeg"
-                        file_name = f"{post_id}_thumbnail.jpg"
-                        await self.send_image(evt, thumbnail_url, mime_type, file_name)
+                    mime_type = mimetypes.guess_type(media_url)[0] or "image/jpeg"
+                    file_name = f"{post_id}_image.jpg"
+                    items.append((MessageType.IMAGE, media_url, mime_type, file_name))
+                await self.add_gallery(post, items)
+            elif "playlist" in embed:
+                playlist_url = embed["playlist"]
+                thumbnail_url = embed.get("thumbnail")
+                self.log.info(f"Video URL: {playlist_url}, Thumbnail URL: {thumbnail_url}")
+                
+                if playlist_url and self.config["bluesky.video"]:
+                    # Without the thumbnail option, the thumbnail is only sent if the video is too large
+                    await self.add_hls_video(post, playlist_url, f"{post_id}_video.mp4",
+                                             thumbnail_url=None if self.config["bluesky.thumbnail"] else thumbnail_url)
+                    if not post.complete:
+                        return post
+
+                if thumbnail_url and self.config["bluesky.thumbnail"]:
+                    mime_type = mimetypes.guess_type(thumbnail_url)[0] or "image/jpeg"
+                    file_name = f"{post_id}_thumbnail.jpg"
+                    await self.add_media(post, MessageType.IMAGE, thumbnail_url, mime_type, file_name)
+
+        return post
     
-    async def download_m3u8_file(self, m3u8_url: str):
-        async with self.http.get(m3u8_url) as response:
+    async def add_hls_video(self, post: ResolvedPost, playlist_url: str, file_name, thumbnail_url=None):
+        # thumbnail_url is sent instead of a video that is too large for the homeserver, like in add_media
+        media = self.upload_cache.get(f"url:{playlist_url}")
+        if not media:
+            try:
+                media = await self.download_hls_video(playlist_url, file_name)
+            except MediaTooLarge as e:
+                self.log.info(f"Not sending {file_name}: {e}")
+                if thumbnail_url:
+                    await self.add_thumbnail(post, thumbnail_url, file_name)
+                return
+            except MEDIA_ERRORS as e:
+                self.log.warning(f"Failed to fetch {file_name}: {e!r}")
+            if not media:
+                self.log.warning(f"Failed to download video from {playlist_url}")
+                post.complete = False
+                return
+        post.media.append(PostMedia(media.uri, media.mimetype, media.size, file_name, MessageType.VIDEO))
+
+    async def download_hls_video(self, playlist_url: str, file_name) -> Optional[UploadedMedia]:
+        # Segments go to a file that only stays in memory while it is small
+        with tempfile.SpooledTemporaryFile(max_size=self.config["download.spool_size"]) as spool:
+            # The download timeout covers the whole video, not each of its segments
+            timeout = self.config["timeouts.download"]
+            deadline = asyncio.get_running_loop().time() + timeout if timeout else None
+            # The size of the video is only known once all segments are in, so it reserves as
+            # much as a DASH video may take
+            async with self.scheduler.transfer(await self.get_max_size() or self.config["download.spool_size"]):
+                result = await self.download_m3u8_file(playlist_url, spool, deadline)
+            if not result:
+                return None
+            size, digest = result
+            spool.seek(0)
+            return await self.upload_cached(iter_file(spool), "video/mp4", file_name, cache_url=playlist_url, size=size, digest=digest)
+
+    async def download_m3u8_file(self, m3u8_url: str, out: IO[bytes], deadline: Optional[float]) -> Optional[Tuple[int, str]]:
+        # Writes the video to out and returns its size and SHA-256, or None if the download failed.
+        # deadline is in loop time, None means no limit.
+        loop = asyncio.get_running_loop()
+
+        def remaining() -> Optional[float]:
+            # Fails as soon as the deadline has passed, a timeout of 0 would mean no limit to aiohttp
+            if deadline is None:
+                return None
+            seconds = deadline - loop.time()
+            if seconds <= 0:
+                raise asyncio.TimeoutError()
+            return seconds
+
+        try:
+            timeout = aiohttp.ClientTimeout(total=remaining())
+        except asyncio.TimeoutError:
+            self.log.warning(f"Timed out before fetching playlist {m3u8_url}")
+            return None
+        async with self.http.get(m3u8_url, timeout=timeout) as response:
             if response.status != 200:
                 self.log.warning(f"Failed to fetch playlist: {m3u8_url} — HTTP {response.status}")
-                return b''
+                return None
             playlist = await response.text()
         
         if "#EXT-X-STREAM-INF" in playlist:
-            lines = playlist.strip().splitlines()
-            next_m3u8 = next((line for line in lines if not line.startswith("#")), None)
-            if not next_m3u8:
+            variant = choose_rendition(parse_hls_variants(playlist, m3u8_url), self.config["download.max_pixels"])
+            if not variant:
                 self.log.warning(f"No variant found in master playlist: {m3u8_url}")
-                return b''
-            nested_url = urljoin(m3u8_url, next_m3u8)
-            return await self.download_m3u8_file(nested_url)
+                return None
+            return await self.download_m3u8_file(variant.url, out, deadline)
 
         segment_urls = []
         base_url = m3u8_url.rsplit("/", 1)[0] + "/"
@@ -419,21 +1734,61 @@ class SocialMediaDownloadPlugin(Plugin):
 
         if not segment_urls:
             self.log.warning(f"No segments found in: {m3u8_url}")
-            return b''
+            return None
 
-        segment_data = []
-        for i, url in enumerate(segment_urls):
-            async with self.http.get(url) as segment_response:
-                if segment_response.status != 200:
-                    self.log.warning(f"Failed to download segment {i + 1}: {url} — HTTP {segment_response.status}")
-                    continue
-                segment_data.append(await segment_response.read())
-                if i % 10 == 0:
-                    self.log.debug(f"Downloaded segment {i + 1}/{len(segment_urls)}")
+        # Segments are downloaded in a sliding window and written in playlist order, so at most
+        # segment_concurrency segments are held in memory at any time. A missing segment would corrupt
+        # the video, so the first segment that fails for good (or running out of time) aborts the download.
+        window = max(1, self.config["bluesky.segment_concurrency"])
+        upload_limit = await self.get_upload_limit()
+        pending = deque()
+        next_index = 0
+        size, digest = 0, hashlib.sha256()
+        try:
+            while next_index < len(segment_urls) or pending:
+                while next_index < len(segment_urls) and len(pending) < window:
+                    url = segment_urls[next_index]
+                    pending.append(asyncio.create_task(self.download_segment(url, next_index, len(segment_urls))))
+                    next_index += 1
+                data = await asyncio.wait_for(pending[0], timeout=remaining())
+                pending.popleft()
+                out.write(data)
+                size += len(data)
+                digest.update(data)
+                if upload_limit and size > upload_limit:
+                    raise MediaTooLarge(f"{m3u8_url} exceeds the upload limit of {upload_limit} bytes")
+        except SegmentDownloadError as e:
+            self.log.warning(f"Failed to download {m3u8_url}: {e}")
+            return None
+        except asyncio.TimeoutError:
+            self.log.warning(f"Timed out downloading segments of {m3u8_url}")
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
 
-        if not segment_data:
-            self.log.warning("All segment downloads failed.")
-            return b''
+        self.log.info(f"All {len(segment_urls)} segments downloaded.")
+        return size, digest.hexdigest()
 
-        self.log.info("All segments downloaded.")
-        return b"".join(segment_data)
+    async def download_segment(self, url: str, i: int, total: int) -> bytes:
+        # A single retry budget for the request and its body, so fetch itself doesn't retry
+        retries = max(0, self.config["bluesky.segment_retries"])
+        delay = 0.0
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+            try:
+                async with self.fetch(url, retries=0) as segment_response:
+                    if segment_response.status == 200:
+                        return await segment_response.read()
+                    if segment_response.status not in RETRY_STATUSES:
+                        raise SegmentDownloadError(f"segment {i + 1}/{total} failed: HTTP {segment_response.status}")
+                    delay = self.retry_delay(attempt, segment_response.headers.get("Retry-After"))
+                    if delay is None:
+                        raise SegmentDownloadError(f"segment {i + 1}/{total} failed: HTTP {segment_response.status}, "
+                                                   f"retry after {segment_response.headers['Retry-After']}")
+                    self.log.warning(f"Failed to download segment {i + 1}/{total}: {url} — HTTP {segment_response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.warning(f"Failed to download segment {i + 1}/{total}: {url} — {e!r}")
+                delay = self.retry_delay(attempt)
+        raise SegmentDownloadError(f"segment {i + 1}/{total} failed after {retries + 1} attempts")
@@ -0,0 +1,26 @@
+# Microbenchmark of find_links over a chat corpus, most messages of which contain no link at all.
+# Usage: python tests/benchmark_find_links.py [repeat]
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from socialmediadownload import find_links  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "chat_corpus.txt")
+
+
+def main() -> None:
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open(CORPUS, encoding="utf-8") as file:
+        messages = file.read().splitlines()
+    with_links = [message for message in messages if find_links(message)]
+    without_links = [message for message in messages if message not in with_links]
+
+    for name, corpus in (("all messages", messages), ("with links", with_links), ("without links", without_links)):
+        seconds = min(timeit.repeat(lambda: [find_links(message) for message in corpus], number=repeat, repeat=5))
+        print(f"{name:>14}: {len(corpus):3} messages, {seconds / repeat / len(corpus) * 1e6:6.2f} µs per message")
+
+
+if __name__ == "__main__":
+    main()
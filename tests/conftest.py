@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The plugin is a single module at the repository root, maubot loads it without installing anything
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
@@ -0,0 +1,134 @@
+import pytest
+
+import socialmediadownload
+
+canonical_post_id = socialmediadownload.canonical_post_id
+canonical_url = socialmediadownload.canonical_url
+post_file_name = socialmediadownload.post_file_name
+find_links = socialmediadownload.find_links
+
+
+def post_key(link: str):
+    [(platform, url_tup)] = find_links(link)
+    return platform, canonical_post_id(platform, url_tup)
+
+
+# Every way of writing a link to the same post maps to the same key
+VARIANTS = {
+    ("youtube", "dQw4w9WgXcQ"): [
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://youtube.com/watch?v=dQw4w9WgXcQ",
+        "http://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://m.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://m.youtube.com/watch?v=dQw4w9WgXcQ&t=42s",
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL123&index=2",
+        "https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+        "https://youtu.be/dQw4w9WgXcQ",
+        "https://youtu.be/dQw4w9WgXcQ?si=Q1w2E3r4T5y6",
+        "https://youtu.be/dQw4w9WgXcQ?t=42",
+        "https://www.youtube.com/embed/dQw4w9WgXcQ",
+        "https://www.youtube.com/v/dQw4w9WgXcQ",
+        "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+        "https://youtube.com/shorts/dQw4w9WgXcQ?feature=share",
+        "https://www.youtube.com/live/dQw4w9WgXcQ",
+    ],
+    ("reddit", "1abcde2"): [
+        "https://www.reddit.com/r/aww/comments/1abcde2/my_cat/",
+        "https://reddit.com/r/aww/comments/1abcde2",
+        "https://old.reddit.com/r/aww/comments/1abcde2/my_cat/",
+        "https://nm.reddit.com/r/aww/comments/1abcde2/my_cat/",
+        "https://m.reddit.com/r/aww/comments/1abcde2/",
+        "https://www.reddit.com/r/Aww/comments/1ABCDE2/my_cat/?utm_source=share&utm_medium=web2x",
+        "https://www.reddit.com/r/aww/comments/1abcde2/comment/kxyz123/",
+    ],
+    ("instagram", "C1a2B3c4D5e"): [
+        "https://www.instagram.com/p/C1a2B3c4D5e/",
+        "https://instagram.com/p/C1a2B3c4D5e",
+        "https://www.instagram.com/p/C1a2B3c4D5e/?igsh=MWZ2dGd4bmZ0",
+        "https://www.instagram.com/reel/C1a2B3c4D5e/",
+        "https://www.instagram.com/reels/C1a2B3c4D5e/",
+        "https://www.instagram.com/tv/C1a2B3c4D5e/",
+        "https://www.instagram.com/someone/p/C1a2B3c4D5e/",
+    ],
+    ("tiktok", "7301234567890123456"): [
+        "https://www.tiktok.com/@creator.name/video/7301234567890123456",
+        "https://tiktok.com/@creator.name/video/7301234567890123456?is_from_webapp=1&sender_device=pc",
+        "https://m.tiktok.com/@other_name/video/7301234567890123456",
+    ],
+    ("tiktok", "vm.tiktok.com/ZMabc1234"): [
+        "https://vm.tiktok.com/ZMabc1234/",
+        "https://vm.tiktok.com/ZMabc1234",
+        "vm.tiktok.com/ZMabc1234/?k=1",
+    ],
+    ("tiktok", "tiktok.com/t/ZMabc1234"): [
+        "https://www.tiktok.com/t/ZMabc1234/",
+        "https://tiktok.com/t/ZMabc1234",
+    ],
+    ("bluesky", "someone.bsky.social/3kxyzabc123de"): [
+        "https://bsky.app/profile/someone.bsky.social/post/3kxyzabc123de",
+        "https://bsky.app/profile/Someone.bsky.social/post/3kxyzabc123de",
+        "bsky.app/profile/someone.bsky.social/post/3kxyzabc123de",
+    ],
+}
+
+
+@pytest.mark.parametrize("key, link", [(key, link) for key, links in VARIANTS.items() for link in links])
+def test_canonical_post_id(key, link):
+    assert post_key(link) == key
+
+
+def test_keys_are_distinct():
+    assert len(set(VARIANTS)) == len(VARIANTS)
+    # Record keys of Bluesky posts are case sensitive
+    assert post_key("https://bsky.app/profile/a.bsky.social/post/3kAbC") != post_key("https://bsky.app/profile/a.bsky.social/post/3kabc")
+    # So are YouTube video IDs
+    assert post_key("https://youtu.be/dQw4w9WgXcQ") != post_key("https://youtu.be/dqw4w9wgxcq")
+    # Short links on different domains are different links
+    assert post_key("https://vm.tiktok.com/ZMabc1234/") != post_key("https://www.tiktok.com/t/ZMabc1234/")
+
+
+@pytest.mark.parametrize("link", [
+    # Share links have to be followed to know the post
+    "https://www.reddit.com/r/pics/s/AbCdEf1234",
+    # Stories only contain the user name
+    "https://www.instagram.com/stories/someone/3301234567890123456/",
+    # No video ID
+    "https://www.youtube.com/watch?feature=share",
+])
+def test_no_canonical_post_id(link):
+    assert post_key(link)[1] is None
+
+
+@pytest.mark.parametrize("platform, post_id, url", [
+    ("youtube", "dQw4w9WgXcQ", "https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+    ("reddit", "1abcde2", "https://www.reddit.com/comments/1abcde2/"),
+    ("instagram", "C1a2B3c4D5e", "https://www.instagram.com/p/C1a2B3c4D5e/"),
+    ("tiktok", "7301234567890123456", "https://www.tiktok.com/video/7301234567890123456"),
+    ("tiktok", "vm.tiktok.com/ZMabc1234", "https://vm.tiktok.com/ZMabc1234"),
+    ("bluesky", "someone.bsky.social/3kxyzabc123de", "https://bsky.app/profile/someone.bsky.social/post/3kxyzabc123de"),
+])
+def test_canonical_url(platform, post_id, url):
+    assert canonical_url(platform, post_id) == url
+
+
+def test_canonical_url_is_stable_across_variants():
+    for (platform, post_id), links in VARIANTS.items():
+        urls = {canonical_url(*post_key(link)) for link in links}
+        assert urls == {canonical_url(platform, post_id)}
+
+
+def test_canonical_url_unknown_platform():
+    with pytest.raises(ValueError):
+        canonical_url("myspace", "1")
+
+
+@pytest.mark.parametrize("post_id, suffix, file_name", [
+    ("7301234567890123456", ".mp4", "7301234567890123456.mp4"),
+    ("dQw4w9WgXcQ", ".jpg", "dQw4w9WgXcQ.jpg"),
+    ("vm.tiktok.com/ZMabc1234", ".mp4", "vm_tiktok_com_ZMabc1234.mp4"),
+    ("someone.bsky.social/3kxyz", "_video.mp4", "someone_bsky_social_3kxyz_video.mp4"),
+    ("../../etc/passwd", "", "______etc_passwd"),
+])
+def test_post_file_name(post_id, suffix, file_name):
+    assert post_file_name(post_id, suffix) == file_name
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from conftest import FIXTURES
+import socialmediadownload
+
+Rendition = socialmediadownload.Rendition
+choose_rendition = socialmediadownload.choose_rendition
+parse_dash_manifest = socialmediadownload.parse_dash_manifest
+parse_iso_duration = socialmediadownload.parse_iso_duration
+
+MANIFEST_URL = "https://v.redd.it/abc123/DASHPlaylist.mpd?a=1"
+
+
+def load_manifest(name: str):
+    with open(os.path.join(FIXTURES, name)) as file:
+        return parse_dash_manifest(file.read(), MANIFEST_URL)
+
+
+@pytest.mark.parametrize("duration, seconds", [
+    ("PT0H0M12.500S", 12.5),
+    ("PT1M5S", 65.0),
+    ("PT2H", 7200.0),
+    ("PT1H2M3.25S", 3723.25),
+    ("PT0S", 0.0),
+    ("", 0.0),
+    (None, 0.0),
+    ("P1D", 0.0),
+    ("12.5", 0.0),
+])
+def test_parse_iso_duration(duration, seconds):
+    assert parse_iso_duration(duration) == seconds
+
+
+def test_parse_dash_manifest():
+    manifest = load_manifest("reddit_dash.mpd")
+    assert manifest.duration == 12.5
+    assert [(video.width, video.height, video.bandwidth) for video in manifest.videos] == [
+        (426, 240, 273000), (1280, 720, 1804000), (1920, 1080, 4512000)]
+    # BaseURLs are relative to the manifest, without its query
+    assert manifest.videos[1].url == "https://v.redd.it/abc123/DASH_720.mp4"
+    assert [audio.url for audio in manifest.audios] == [
+        "https://v.redd.it/abc123/DASH_AUDIO_64.mp4", "https://v.redd.it/abc123/DASH_AUDIO_128.mp4"]
+    assert [audio.bandwidth for audio in manifest.audios] == [67000, 131000]
+
+
+def test_parse_dash_manifest_mime_type_on_representation():
+    # Older manifests have no contentType, and representations without a BaseURL are skipped
+    manifest = load_manifest("reddit_dash_legacy.mpd")
+    assert manifest.duration == 65.0
+    assert [video.url for video in manifest.videos] == [
+        "https://v.redd.it/abc123/DASH_360", "https://v.redd.it/abc123/DASH_480"]
+    assert [audio.url for audio in manifest.audios] == ["https://v.redd.it/abc123/DASH_audio"]
+
+
+def test_parse_dash_manifest_invalid():
+    with pytest.raises(socialmediadownload.ElementTree.ParseError):
+        parse_dash_manifest("<MPD><Period>", MANIFEST_URL)
+
+
+def test_choose_rendition_without_limits():
+    videos = load_manifest("reddit_dash.mpd").videos
+    assert choose_rendition(videos).height == 1080
+    assert choose_rendition(videos, 0, 0, 12.5).height == 1080
+
+
+def test_choose_rendition_max_pixels():
+    videos = load_manifest("reddit_dash.mpd").videos
+    assert choose_rendition(videos, 1280 * 720).height == 720
+    assert choose_rendition(videos, 1280 * 720 - 1).height == 240
+
+
+def test_choose_rendition_max_bytes():
+    manifest = load_manifest("reddit_dash.mpd")
+    # 1080p is about 7 MB over 12.5 seconds, 720p about 2.8 MB
+    assert choose_rendition(manifest.videos, 0, 5_000_000, manifest.duration).height == 720
+    assert choose_rendition(manifest.videos, 0, 8_000_000, manifest.duration).height == 1080
+    # Without a duration the size can't be estimated, so only the pixels count
+    assert choose_rendition(manifest.videos, 0, 5_000_000).height == 1080
+
+
+def test_choose_rendition_nothing_fits():
+    videos = load_manifest("reddit_dash.mpd").videos
+    assert choose_rendition(videos, 100 * 100).height == 240
+    assert choose_rendition(videos, 0, 1, 12.5).height == 240
+
+
+def test_choose_rendition_prefers_bandwidth_at_same_resolution():
+    renditions = [Rendition("high", 1280, 720, 3000000), Rendition("low", 1280, 720, 1000000)]
+    assert choose_rendition(renditions).url == "high"
+    assert choose_rendition(renditions, 0, 1000000 * 10 / 8, 10).url == "low"
+
+
+def test_choose_rendition_empty():
+    assert choose_rendition([]) is None
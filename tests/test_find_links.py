@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+import socialmediadownload
+
+find_links = socialmediadownload.find_links
+
+
+def platforms(body: str):
+    return [platform for platform, _ in find_links(body)]
+
+
+def test_no_links():
+    assert find_links("") == []
+    assert find_links("good morning everyone, lunch at 12?") == []
+    assert find_links("https://www.example.com/some/page") == []
+
+
+def test_links_in_order():
+    body = ("first https://www.instagram.com/p/C1a2B3c4D5e/ then https://youtu.be/dQw4w9WgXcQ "
+            "and https://bsky.app/profile/someone.bsky.social/post/3kxyz")
+    assert platforms(body) == ["instagram", "youtube", "bluesky"]
+
+
+def test_several_links_in_one_token():
+    assert find_links("https://www.reddit.com/r/a/comments/x,https://youtu.be/y") == [
+        ("reddit", ("https://", "www.", "reddit.com", "/r/a/comments/x")),
+        ("youtube", ("https://", "", "youtu.be", "/", "y", "")),
+    ]
+    assert platforms("(https://youtu.be/abc)(https://www.instagram.com/p/XYZ/)") == ["youtube", "instagram"]
+    assert platforms("https://www.tiktok.com/@u/video/1;https://bsky.app/profile/a.b/post/3k") == ["tiktok", "bluesky"]
+
+
+def test_unsupported_path_of_supported_domain():
+    assert find_links("https://www.reddit.com/r/aww/") == []
+    assert find_links("https://www.instagram.com/someone/") == []
+
+
+# Inputs that made the old regexes backtrack, or that would make a parser quadratic. Each takes
+# milliseconds for 100k characters, the bounds leave a lot of room for slow machines but not for
+# superlinear behaviour.
+PATHOLOGICAL = {
+    "instagram_segments": lambda n: "instagram.com" + "/a" * (n // 2),
+    "reddit_segments": lambda n: "https://www.reddit.com/r/" + "a/" * (n // 2),
+    "tiktok_user": lambda n: "tiktok.com/@" + "a" * n,
+    "youtube_path": lambda n: "https://youtube.com/" + "-" * n,
+    "youtube_slashes": lambda n: "/" * n + "youtu.be",
+    "bluesky_handle": lambda n: "bsky.app/profile/" + "a." * (n // 2),
+    "subdomains": lambda n: "www." * (n // 4) + "reddit.com/r/a/comments/b",
+    "domains_in_one_token": lambda n: "youtu.be" * (n // 8),
+    "links_in_one_token": lambda n: "https://youtu.be/a,https://www.instagram.com/p/b/," * (n // 50),
+    "many_tokens": lambda n: "https://www.reddit.com/r/a/comments/b " * (n // 38),
+}
+MAX_SECONDS = 1.0
+
+
+def best_time(body: str) -> float:
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        find_links(body)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@pytest.mark.parametrize("name", PATHOLOGICAL)
+def test_pathological_input_is_fast(name):
+    assert best_time(PATHOLOGICAL[name](100_000)) < MAX_SECONDS
+
+
+@pytest.mark.parametrize("name", PATHOLOGICAL)
+def test_pathological_input_scales_linearly(name):
+    small = best_time(PATHOLOGICAL[name](20_000))
+    large = best_time(PATHOLOGICAL[name](200_000))
+    # Ten times the input, quadratic behaviour would take a hundred times as long
+    assert large < max(small, 1e-3) * 30
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+import aiohttp
+import pytest
+
+import socialmediadownload
+
+CircuitBreaker = socialmediadownload.CircuitBreaker
+PostNotFound = socialmediadownload.PostNotFound
+RequestBatcher = socialmediadownload.RequestBatcher
+TTLCache = socialmediadownload.TTLCache
+find_links = socialmediadownload.find_links
+
+
+class FakeResponse:
+    def __init__(self, status: int, data: dict) -> None:
+        self.status = status
+        self.data = data
+
+    async def json(self) -> dict:
+        return self.data
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise aiohttp.ClientError(f"HTTP {self.status}")
+
+    async def __aenter__(self) -> "FakeResponse":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass
+
+
+class FakeHttp:
+    def __init__(self, response: FakeResponse) -> None:
+        self.response = response
+        self.urls = []
+
+    def get(self, url, **kwargs) -> FakeResponse:
+        self.urls.append(url)
+        return self.response
+
+    def request(self, method, url, **kwargs) -> FakeResponse:
+        return self.get(url, **kwargs)
+
+
+def make_plugin(response: FakeResponse):
+    # Only what resolving reddit and Bluesky posts needs, without a running maubot
+    plugin = socialmediadownload.SocialMediaDownloadPlugin.__new__(socialmediadownload.SocialMediaDownloadPlugin)
+    plugin.log = logging.getLogger("socialmediadownload")
+    plugin.config = {"timeouts.resolve": 30, "reddit.info": True, "bluesky.info": True}
+    plugin.http = FakeHttp(response)
+    plugin.breakers = {"public.api.bsky.app": CircuitBreaker("public.api.bsky.app", 5, 60)}
+    plugin.reddit_posts = RequestBatcher(plugin.fetch_reddit_posts, 0, 100)
+    plugin.bluesky_posts = RequestBatcher(plugin.fetch_bluesky_posts, 0, 25)
+    plugin.bluesky_dids = TTLCache(10, 3600)
+    plugin.bluesky_dids.put("someone.bsky.social", "did:plc:someone")
+    return plugin
+
+
+def resolve(plugin, link: str):
+    [(platform, url_tup)] = find_links(link)
+    return asyncio.run(getattr(plugin, f"resolve_{platform}")(url_tup))
+
+
+REDDIT_LINK = "https://www.reddit.com/r/aww/comments/1abcde2/my_cat/"
+BLUESKY_LINK = "https://bsky.app/profile/someone.bsky.social/post/3kxyzabc123de"
+
+
+def test_reddit_post_missing_from_listing():
+    plugin = make_plugin(FakeResponse(200, {"data": {"children": []}}))
+    with pytest.raises(PostNotFound):
+        resolve(plugin, REDDIT_LINK)
+    assert plugin.http.urls == ["https://www.reddit.com/by_id/t3_1abcde2.json"]
+
+
+def test_reddit_listing_failure_is_not_missing():
+    plugin = make_plugin(FakeResponse(503, {}))
+    assert resolve(plugin, REDDIT_LINK) is None
+
+
+def test_bluesky_post_missing_from_get_posts():
+    plugin = make_plugin(FakeResponse(200, {"posts": []}))
+    with pytest.raises(PostNotFound):
+        resolve(plugin, BLUESKY_LINK)
+    assert plugin.http.urls == ["https://public.api.bsky.app/xrpc/app.bsky.feed.getPosts"]
+
+
+def test_bluesky_get_posts_failure_is_not_missing():
+    plugin = make_plugin(FakeResponse(503, {}))
+    assert resolve(plugin, BLUESKY_LINK) is None